@@ -1,25 +1,11 @@
-from ortools.constraint_solver import routing_enums_pb2
-from ortools.constraint_solver import pywrapcp
-import requests
+import argparse
+import hashlib
 import json
-import urllib
-import urllib.request        
-from flask import Flask, request, render_template
-from flask_restful import Resource, Api, reqparse
-from marshmallow import Schema, fields
-import re
-import xlsxwriter
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
-import io
-import streamlit as st # "conda install protobuf=3.20.1" (dependency package), newer versions wont work w streamlit, older versions wont work w ortools
-from FeatureEngineering import create_time_matrix
-from MatchingAlgorithm import run_algorithm
+import os
+import threading
+import time
 
-import firebase_admin
-from firebase_admin import firestore
-import pyrebase
+import pandas as pd
 
 config = {
     "apiKey": "", # Firebase API key
@@ -32,29 +18,190 @@ config = {
     "databaseURL": "https://bt4103-capstone-e15b0-default-rtdb.asia-southeast1.firebasedatabase.app/" # additional parameter: required
 }
 
-firebase = pyrebase.initialize_app(config)
-db = firebase.database()
+# Rows written per multi-path update request
+CHUNK_SIZE = 500
+# Hashes of the rows as of the last sync, for incremental syncs
+SYNC_STATE_PATH = 'firebase_sync_state.json'
+# Replaced by Firebase with its own clock on write, loaders can then fetch only rows changed since a time
+SERVER_TIMESTAMP = {'.sv': 'timestamp'}
+
+def get_database(config=config):
+    import pyrebase # "pip install pyrebase4"
+
+    firebase = pyrebase.initialize_app(config)
+    return firebase.database()
+
+def frame_records(df, key_column=None):
+    """ {key: row dict} of every row with JSON-native values (NaN as None), keyed by key_column or row position."""
+    records = df.astype(object).where(df.notna(), None).to_dict(orient='records')
+    keys = df[key_column].tolist() if key_column is not None else range(len(df))
+    return {str(key): record for key, record in zip(keys, records)}
+
+def row_hash(record):
+    return hashlib.sha1(json.dumps(record, sort_keys=True, default=str).encode()).hexdigest()
+
+def build_updates(tables, previous_hashes=None, timestamp=True):
+    """
+    Multi-path update writing every row of tables ({path: frame_records(...)}) to "path/key".
+
+    previous_hashes: row hashes of the last sync, only rows that changed since are written and rows that
+            are gone are removed. None writes every row
+    timestamp: stamp every written row with its server side 'updated_at' time
+
+    Returns (updates, hashes) where hashes are the row hashes to keep for the next sync.
+    """
+    updates = {}
+    hashes = {}
+    for path, records in tables.items():
+        for key, record in records.items():
+            row_path = '{}/{}'.format(path, key)
+            hashes[row_path] = row_hash(record)
+            if previous_hashes is None or previous_hashes.get(row_path) != hashes[row_path]:
+                updates[row_path] = dict(record, updated_at=SERVER_TIMESTAMP) if timestamp else record
+
+    if previous_hashes is not None:
+        for row_path in previous_hashes:
+            if row_path not in hashes and row_path.split('/')[0] in tables:
+                updates[row_path] = None
+    return updates, hashes
+
+def write_updates(db, updates, chunk_size=CHUNK_SIZE):
+    """ Send the multi-path update in requests of at most chunk_size paths. Returns the number of requests."""
+    items = list(updates.items())
+    for start in range(0, len(items), chunk_size):
+        db.update(dict(items[start:start + chunk_size]))
+    return (len(items) + chunk_size - 1) // chunk_size
+
+def load_sync_state(state_path=SYNC_STATE_PATH):
+    if state_path is None or not os.path.exists(state_path):
+        return {}
+    with open(state_path) as file:
+        return json.load(file)
+
+def save_sync_state(hashes, state_path=SYNC_STATE_PATH):
+    if state_path is None:
+        return
+    with open(state_path, 'w') as file:
+        json.dump(hashes, file)
+
+def sync_frames(db, orders_df, phlebs_df, catchments_df, incremental=False, state_path=SYNC_STATE_PATH,
+                chunk_size=CHUNK_SIZE, timestamp=True):
+    """
+    Upload the orders, phlebotomists and catchments to the 'orders', 'phlebotomists' and 'catchment' trees
+    in batched multi-path updates.
+
+    db: a pyrebase database (get_database), or anything with the same update(data) method such as a stub
+    incremental: only write rows that changed since the last sync recorded at state_path, and remove rows
+            that are no longer there. The state is saved after every sync once all chunks are written
+    Returns the number of row paths written.
+    """
+    tables = {
+        'orders': frame_records(orders_df, 'order_id'),
+        'phlebotomists': frame_records(phlebs_df, 'phleb_id'),
+        'catchment': frame_records(catchments_df),
+    }
+    previous_hashes = load_sync_state(state_path) if incremental else None
+    updates, hashes = build_updates(tables, previous_hashes, timestamp)
+    write_updates(db, updates, chunk_size)
+    save_sync_state(hashes, state_path)
+    return len(updates)
+
+
+def _rows(value):
+    """ {key: row} from a pyrebase .val(), which is a list when the keys are 0, 1, 2, ..."""
+    if value is None:
+        return {}
+    if isinstance(value, list):
+        return {str(key): row for key, row in enumerate(value) if row is not None}
+    return {str(key): row for key, row in value.items() if row is not None}
+
+
+class FirebaseTable:
+    """
+    One tree of the database (e.g. 'orders') held as a DataFrame and kept up to date incrementally,
+    for frontends that rerun often such as ApiStreamlit.
+
+    refresh() fetches only the rows whose server side 'updated_at' stamp (see sync_frames) is newer than the
+    newest one seen so far, and upserts them by key. As deletions can't be seen that way, the whole tree is
+    reloaded every full_refresh_seconds, which also picks up any write stamped in the same millisecond as the
+    newest rows but landing after they were read. The delta query needs ".indexOn": "updated_at" on the tree
+    in the database rules.
+
+    db: a pyrebase database not shared with other threads, pyrebase builds its queries in place
+    columns: the columns to keep, missing ones are added empty
+    refresh_seconds: refresh() does nothing when the last refresh is more recent than this
+    max_rows: keep at most this many most recently updated rows, None for no limit. truncated tells whether
+            rows were left out on the last refresh
+    """
+    def __init__(self, db, path, columns, refresh_seconds=30, full_refresh_seconds=3600, max_rows=None):
+        self.db = db
+        self.path = path
+        self.columns = list(columns)
+        self.refresh_seconds = refresh_seconds
+        self.full_refresh_seconds = full_refresh_seconds
+        self.max_rows = max_rows
+        self.last_updated_at = None
+        self.last_refresh = None
+        self.last_full_refresh = None
+        self.truncated = False
+        self._frame = pd.DataFrame(columns=self.columns + ['updated_at'])
+        self._lock = threading.Lock()
+
+    def _fetch(self, since=None):
+        query = self.db.child(self.path)
+        if since is not None:
+            query = query.order_by_child('updated_at').start_at(since)
+        rows = _rows(query.get().val())
+        frame = pd.DataFrame.from_dict(rows, orient='index')
+        return frame.reindex(columns=self.columns + ['updated_at'])
+
+    def refresh(self, force=False):
+        """ Bring the frame up to date if it is due (or force). Returns True if the frame was rebuilt."""
+        with self._lock:
+            now = time.monotonic()
+            if not force and self.last_refresh is not None and now - self.last_refresh < self.refresh_seconds:
+                return False
+
+            if self.last_full_refresh is None or now - self.last_full_refresh >= self.full_refresh_seconds:
+                frame = self._fetch()
+                self.last_full_refresh = now
+            else:
+                # start_at is inclusive, and sync_frames gives every row of an update the same stamp, so
+                # starting at the newest stamp would fetch the rows of the last update again on every refresh
+                changed = self._fetch(0 if self.last_updated_at is None else self.last_updated_at + 1)
+                if changed.empty:
+                    self.last_refresh = now
+                    return False
+                frame = pd.concat([self._frame.drop(index=changed.index, errors='ignore'), changed])
+            self.last_refresh = now
+
+            self.truncated = self.max_rows is not None and len(frame) > self.max_rows
+            if self.truncated:
+                frame = frame.sort_values('updated_at', na_position='first').iloc[-self.max_rows:]
+            frame = frame.sort_index(key=lambda index: pd.to_numeric(index, errors='coerce'))
+            if frame['updated_at'].notna().any():
+                self.last_updated_at = int(frame['updated_at'].max())
+            self._frame = frame
+            return True
 
-orders = pd.read_csv("Simulated Data/order_data_1576.csv")
-phleb = pd.read_csv("Simulated Data/phleb_data_1576.csv")
-catchment = pd.read_csv("Simulated Data/catchment_data_1576.csv")
+    def frame(self):
+        """ The current rows in key order, with the configured columns."""
+        with self._lock:
+            return self._frame[self.columns].reset_index(drop=True)
 
-orders_json = orders.to_dict()
-phleb_json = phleb.to_dict()
-catchment_json = catchment.to_dict()
 
-for index in range(len(orders)):
-    order_id = orders['order_id'].iloc[index]
-    json = orders.iloc[index].to_dict()
-    db.child('orders').child(order_id).set(json)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upload the simulated data to the Firebase Realtime Database")
+    parser.add_argument('--incremental', action='store_true', help="only write rows changed since the last sync")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="rows per update request")
+    parser.add_argument('--database-url', default=config['databaseURL'],
+                        help="e.g. the Realtime Database emulator's URL for testing")
+    args = parser.parse_args()
 
-for index in range(len(phleb)):
-    phleb_id = phleb['phleb_id'].iloc[index]
-    json = phleb.iloc[index].to_dict()
-    db.child('phlebotomists').child(phleb_id).set(json)
+    orders = pd.read_csv("Simulated Data/order_data_1576.csv")
+    phleb = pd.read_csv("Simulated Data/phleb_data_1576.csv")
+    catchment = pd.read_csv("Simulated Data/catchment_data_1576.csv")
 
-catchment_counter = 0
-for index in range(len(catchment)):
-    json = catchment.iloc[index].to_dict()
-    db.child('catchment').child(catchment_counter).set(json)
-    catchment_counter += 1
\ No newline at end of file
+    db = get_database(dict(config, databaseURL=args.database_url))
+    written = sync_frames(db, orders, phleb, catchment, incremental=args.incremental, chunk_size=args.chunk_size)
+    print("{} rows written".format(written))
@@ -4,7 +4,7 @@ import requests
 import json
 import urllib
 import urllib.request        
-from flask import Flask, request, render_template
+from flask import Flask, Response, request, render_template
 from flask_restful import Resource, Api, reqparse
 from marshmallow import Schema, fields
 import ast
@@ -15,7 +15,10 @@ import matplotlib.pyplot as plt
 import streamlit as st
 
 from FeatureEngineering import create_time_matrix
-from MatchingAlgorithm import run_algorithm
+from MatchingAlgorithm import run_algorithm, solve_and_extract, build_output, encode_output
+import RouteExport
+from SolveJobs import JobManager, CANCELLED, FAILED
+from ResultCache import ResultCache
 
 orders = pd.read_csv("Simulated Data/order_data_1576.csv")
 phleb = pd.read_csv("Simulated Data/phleb_data_1576.csv")
@@ -27,16 +30,60 @@ catchment = catchment.iloc[:1]
 
 API_key = '' #INPUT YOUR OWN API KEY
 
-result = run_algorithm(orders, catchment, phleb, API_key)
-
-json_object = json.loads(result)
-routes = json_object['Routes']
-routes = pd.json_normalize(routes)
+# Solve results by input contents, kept on disk for a day so restarts and resubmitted inputs don't solve again
+result_cache = ResultCache('result_cache.sqlite', ttl_seconds=24 * 3600)
 
 ###
 app = Flask(__name__)
 api = Api(app)
 
+# Jobs keep the solution's arrays (see solve_and_extract), so their routes can be exported as JSON or by stop
+jobs = JobManager(result_cache=result_cache, solver=solve_and_extract)
+
+# The demo slice above is solved in the background from the first /routes or /routes/stops request on, they
+# answer 503 until it is done. Not submitted at import so that importing the API never starts worker processes
+demo_job_id = None
+demo_result = None
+
+def demo_routes():
+    """
+    ((data, extraction, route JSON), None) for the demo slice once it is solved,
+    or (None, error response) while it is being solved or if it failed.
+    """
+    global demo_job_id, demo_result
+    if demo_result is not None:
+        return demo_result, None
+    job = None if demo_job_id is None else jobs.get(demo_job_id)
+    if job is None or (job['status'] == CANCELLED and 'result' not in job):
+        # Not submitted yet, forgotten among later finished jobs or cancelled before it ran. Resubmitting is
+        # instant if it was solved before
+        demo_job_id = jobs.submit(orders, catchment, phleb, API_key)
+        job = jobs.get(demo_job_id)
+    if job['status'] == FAILED:
+        return None, ({'error': job['error']}, 500)
+    if 'result' not in job:
+        return None, ({'error': 'routes are still being computed'}, 503, {'Retry-After': '5'})
+    data, status, extraction = job['result']
+    if extraction is None:
+        return None, ({'error': 'Routing Status: ' + str(status)}, 500)
+    demo_result = (data, extraction, encode_output(build_output(data, extraction)))
+    return demo_result, None
+
+# solve_and_extract options a POST /solve request may set
+SOLVE_OPTIONS = {'isMultiEnds', 'nativeEnds', 'time_limit', 'solution_limit', 'plateau_seconds',
+                 'plateau_solutions', 'portfolio'}
+
+def job_response(job_id, printable=True):
+    """ The job's status with its result as the JSON routes of run_algorithm, None for an unknown job id."""
+    job = jobs.get(job_id)
+    if job is not None and 'result' in job:
+        data, status, extraction = job['result']
+        if extraction is None:
+            job['result'] = 'Routing Status: ' + str(status)
+        else:
+            job['result'] = encode_output(build_output(data, extraction, printable=printable))
+    return job
+
 @app.route('/phlebos')
 def get_phlebos():
     data = phleb.to_dict()
@@ -49,7 +96,100 @@ def get_orders():
 
 @app.route('/routes')
 def get_routes():
-    return {'route': result}, 200
+    demo, error = demo_routes()
+    if error is not None:
+        return error
+    return {'route': demo[2]}, 200
+
+@app.route('/routes/stops')
+def get_route_stops():
+    # ?format=arrow (default, streamed in record batches) or ?format=parquet
+    export_format = request.args.get('format', 'arrow')
+    if export_format not in RouteExport.MIME_TYPES:
+        return {'error': 'format must be one of ' + ', '.join(RouteExport.MIME_TYPES)}, 400
+    demo, error = demo_routes()
+    if error is not None:
+        return error
+    stops = RouteExport.stops_table(demo[0], demo[1])
+    return Response(RouteExport.iter_export(stops, export_format), mimetype=RouteExport.MIME_TYPES[export_format])
+
+@app.route('/solve', methods=['POST'])
+def post_solve():
+    """
+    Queue a solve and return its job id straight away, poll GET /jobs/<id> for the result.
+    Body: {"orders": ..., "phlebotomists": ..., "catchments": ..., "api_key": optional, "options": optional}
+    where the frames are lists of records or column dicts (the format of /orders and /phlebos), and options
+    are run_algorithm keyword arguments from SOLVE_OPTIONS, plus "printable": false to leave the printable
+    routes out of the result.
+    """
+    body = request.get_json(silent=True) or {}
+    missing = [key for key in ('orders', 'phlebotomists', 'catchments') if key not in body]
+    if missing:
+        return {'error': 'missing ' + ', '.join(missing)}, 400
+    options = dict(body.get('options', {}))
+    # Only changes how the result is shown, so it goes on the status url rather than to the solver
+    printable = options.pop('printable', True)
+    unknown = set(options) - SOLVE_OPTIONS
+    if unknown:
+        return {'error': 'unknown options ' + ', '.join(sorted(unknown))}, 400
+
+    try:
+        orders_df = pd.DataFrame(body['orders'])
+        phlebs_df = pd.DataFrame(body['phlebotomists'])
+        catchments_df = pd.DataFrame(body['catchments'])
+    except ValueError as error:
+        return {'error': str(error)}, 400
+
+    job_id = jobs.submit(orders_df, catchments_df, phlebs_df, body.get('api_key', API_key), **options)
+    status_url = '/jobs/' + job_id + ('' if printable else '?printable=false')
+    return {'job_id': job_id, 'status_url': status_url}, 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_response(job_id, printable=request.args.get('printable', 'true') != 'false')
+    if job is None:
+        return {'error': 'unknown job'}, 404
+    return job, 200
+
+@app.route('/jobs/<job_id>/stops')
+def get_job_stops(job_id):
+    """ The finished job's routes with one row per stop, ?format=arrow (default, streamed) or ?format=parquet."""
+    export_format = request.args.get('format', 'arrow')
+    if export_format not in RouteExport.MIME_TYPES:
+        return {'error': 'format must be one of ' + ', '.join(RouteExport.MIME_TYPES)}, 400
+    job = jobs.get(job_id)
+    if job is None:
+        return {'error': 'unknown job'}, 404
+    if 'result' not in job:
+        return {'error': 'job is ' + job['status']}, 409
+    data, status, extraction = job['result']
+    if extraction is None:
+        return {'error': 'Routing Status: ' + str(status)}, 409
+    stops = RouteExport.stops_table(data, extraction)
+    return Response(RouteExport.iter_export(stops, export_format), mimetype=RouteExport.MIME_TYPES[export_format])
+
+@app.route('/jobs/<job_id>/progress')
+def get_job_progress(job_id):
+    """
+    Server-Sent Events stream of the job's search: an 'incumbent' event with the objective, dropped orders and
+    elapsed seconds of every improving solution, then a 'status' event when the job is finished. A client happy
+    with an incumbent can cancel the job with DELETE /jobs/<id> and still get that solution.
+    """
+    if jobs.get(job_id) is None:
+        return {'error': 'unknown job'}, 404
+
+    def stream():
+        for event, payload in jobs.iter_progress(job_id):
+            yield 'event: {}\ndata: {}\n\n'.format(event, json.dumps(payload))
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """ Cancel a queued job, or stop a running one early keeping its best solution so far."""
+    if not jobs.cancel(job_id):
+        return {'error': 'unknown job'}, 404
+    return job_response(job_id), 200
 ###
 
 if __name__ == "__main__":
@@ -15,38 +15,52 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import io
+import time
 import streamlit as st
 from FeatureEngineering import create_time_matrix
-from MatchingAlgorithm import run_algorithm
+from MatchingAlgorithm import run_algorithm, solve_and_extract, build_output
+import RouteExport
+from ResultCache import ResultCache
+from SolveJobs import JobManager, QUEUED, RUNNING, CANCELLING, CANCELLED, FAILED
 
 import firebase_admin
 from firebase_admin import firestore
-import pyrebase
-
-config = {
-    "apiKey": "", # Firebase API key
-    "authDomain": "bt4103-capstone-e15b0.firebaseapp.com",
-    "projectId": "bt4103-capstone-e15b0",
-    "storageBucket": "bt4103-capstone-e15b0.appspot.com",
-    "messagingSenderId": "534528759196",
-    "appId": "1:534528759196:web:990717960c3b7a0e02e459",
-    "measurementId": "G-EN6GENJ15Y",
-    "databaseURL": "https://bt4103-capstone-e15b0-default-rtdb.asia-southeast1.firebasedatabase.app/" # additional parameter: required
-}
-
-firebase = pyrebase.initialize_app(config)
-db = firebase.database()
-
-orders = pd.DataFrame.from_dict(db.child("orders").get().val())
-orders = orders[['order_start','service_artTest','service_pathology','service_vaccination','duration',
-                 'price','buffer','capacity_needed','long','lat','order_id','Acceptable Phleb Indices']]
-
-catchment = pd.DataFrame.from_dict(db.child("catchment").get().val())
-catchment = catchment[['long', 'lat']]
-
-phleb = pd.DataFrame.from_dict(db.child("phlebotomists").get().val())
-phleb = phleb[['shift_start', 'break_start', 'shift_end', 'expertise_artTest', 'expertise_pathology', 'expertise_vaccination',
-               'capacity', 'cost', 'service_rating', 'home_long', 'home_lat', 'phleb_id']]
+from APIFirebase import FirebaseTable, get_database
+
+ORDER_COLUMNS = ['order_start','service_artTest','service_pathology','service_vaccination','duration',
+                 'price','buffer','capacity_needed','long','lat','order_id','Acceptable Phleb Indices']
+CATCHMENT_COLUMNS = ['long', 'lat']
+PHLEB_COLUMNS = ['shift_start', 'break_start', 'shift_end', 'expertise_artTest', 'expertise_pathology', 'expertise_vaccination',
+                 'capacity', 'cost', 'service_rating', 'home_long', 'home_lat', 'phleb_id']
+
+EXCEL_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+# Exports of the current routes, dropped when a new solve is started
+ROUTE_EXPORTS = ["routes_excel", "routes_parquet"]
+TIME_LIMIT = 30
+PROGRESS_POLL_SECONDS = 0.5
+# Rows kept per table, far more than one solve can handle, so a runaway tree can't exhaust the server's memory
+MAX_TABLE_ROWS = 50000
+
+@st.cache_resource
+def get_tables():
+    # One copy of the data for all reruns and sessions, reruns only fetch the rows changed since (see FirebaseTable).
+    # Each table gets its own database object as sessions refresh from different threads
+    return {
+        'orders': FirebaseTable(get_database(), 'orders', ORDER_COLUMNS, max_rows=MAX_TABLE_ROWS),
+        'catchment': FirebaseTable(get_database(), 'catchment', CATCHMENT_COLUMNS, max_rows=MAX_TABLE_ROWS),
+        'phlebotomists': FirebaseTable(get_database(), 'phlebotomists', PHLEB_COLUMNS, max_rows=MAX_TABLE_ROWS),
+    }
+
+def load_frame(path):
+    table = get_tables()[path]
+    table.refresh()
+    if table.truncated:
+        st.warning("Only the {} most recently updated rows of '{}' are loaded".format(MAX_TABLE_ROWS, path))
+    return table.frame()
+
+orders = load_frame('orders')
+catchment = load_frame('catchment')
+phleb = load_frame('phlebotomists')
 
 def convert_to_excel(df):
     output = io.BytesIO()
@@ -55,16 +69,61 @@ def convert_to_excel(df):
     writer.save()
     return output.getvalue()
 
-def get_routes_api(orders, catchment, phleb, API_key):
-    result = run_algorithm(orders, catchment, phleb, API_key)
-    json_object = json.loads(result)
-    routes = json_object['Routes']
+def get_routes_api(data, extraction):
+    routes = build_output(data, extraction)['Routes']
     routes = pd.json_normalize(routes)
     return convert_to_excel(routes)
 
+def get_routes_parquet(data, extraction):
+    return RouteExport.to_parquet(RouteExport.stops_table(data, extraction))
+
+@st.cache_resource
+def get_result_cache():
+    # One cache for all reruns and sessions, so rerunning the script with the same inputs doesn't solve again
+    return ResultCache('result_cache.sqlite', ttl_seconds=24 * 3600)
+
+@st.cache_resource
+def get_jobs():
+    # Solves run in a worker process, so the page keeps responding while one is running. Sessions submitting the
+    # same inputs share a job, and inputs solved before come straight from the result cache
+    return JobManager(max_workers=1, max_finished_jobs=10, result_cache=get_result_cache(), solver=solve_and_extract)
+
 def get_phleb():
     return phleb
 
+def export_button(label, key, build, file_name, mime):
+    """ Button building an export only when clicked, the file is then offered for download until it is built again."""
+    if st.button(label, key=key + "_prepare"):
+        st.session_state[key] = build()
+    if key in st.session_state:
+        st.download_button(
+            label="Download " + file_name,
+            data=st.session_state[key],
+            file_name=file_name,
+            mime=mime,
+            key=key + "_download",
+        )
+
+def show_progress(jobs, job_id):
+    """
+    Progress bar of the job until it is finished. It is redrawn on every poll rather than on every solution,
+    as Streamlit can only stop the script for a rerun (e.g. the stop button) when it updates the page.
+    """
+    bar = st.progress(0.0, text="Queued")
+    job = jobs.get(job_id)
+    while job['status'] in (QUEUED, RUNNING, CANCELLING):
+        events = jobs.progress(job_id)
+        if not events:
+            text = "Queued" if job['status'] == QUEUED else "Waiting for the first solution"
+        else:
+            text = "Solution {}: objective {}, {} orders dropped".format(
+                events[-1]['solutions'], events[-1]['objective'], events[-1]['dropped'])
+        bar.progress(min((time.time() - job['submitted_at']) / TIME_LIMIT, 1.0), text=text)
+        time.sleep(PROGRESS_POLL_SECONDS)
+        job = jobs.get(job_id)
+    bar.empty()
+    return job
+
 st.title('TATA 1mg Matching Algorithm API')
 
 st.text("")
@@ -77,27 +136,32 @@ st.text("")
 st.text("")
 st.text("")
 
-st.download_button(
-    label="Get Phlebotomist Data",
-    data=convert_to_excel(phleb),
-    file_name="phleb.xlsx",
-    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-    key="phleb_download",
-)
-
-st.download_button(
-    label="Get Order Data",
-    data=convert_to_excel(orders),
-    file_name="orders.xlsx",
-    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-    key="order_download",
-)
+export_button("Get Phlebotomist Data", "phleb_excel", lambda: convert_to_excel(phleb), "phleb.xlsx", EXCEL_MIME)
+export_button("Get Order Data", "orders_excel", lambda: convert_to_excel(orders), "orders.xlsx", EXCEL_MIME)
 
 if len(API_key) != 0:
-    st.download_button(
-        label="Get Optimal Routes",
-        data=get_routes_api(orders, catchment.iloc[:1], phleb, API_key),
-        file_name="routes.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        key="routes_download",
-    )
+    jobs = get_jobs()
+    if st.button("Find Optimal Routes", key="solve"):
+        st.session_state["job_id"] = jobs.submit(orders, catchment.iloc[:1], phleb, API_key, time_limit=TIME_LIMIT)
+        for key in ROUTE_EXPORTS:
+            st.session_state.pop(key, None)
+
+    job = jobs.get(st.session_state["job_id"]) if "job_id" in st.session_state else None
+    if job is not None and job['status'] in (QUEUED, RUNNING, CANCELLING):
+        if st.button("Stop and keep the best routes so far", key="cancel"):
+            jobs.cancel(job['id'])
+        job = show_progress(jobs, job['id'])
+
+    if job is not None and job['status'] == FAILED:
+        st.error(job['error'])
+    elif job is not None and 'result' in job:
+        data, status, extraction = job['result']
+        if extraction is None:
+            st.error('Routing Status: ' + str(status))
+        else:
+            export_button("Get Optimal Routes", "routes_excel", lambda: get_routes_api(data, extraction),
+                          "routes.xlsx", EXCEL_MIME)
+            export_button("Get Optimal Routes (Parquet, one row per stop)", "routes_parquet",
+                          lambda: get_routes_parquet(data, extraction), "routes.parquet", RouteExport.MIME_TYPES['parquet'])
+    elif job is not None and job['status'] == CANCELLED:
+        st.warning("The solve was stopped before it started")
@@ -0,0 +1,125 @@
+"""
+Offline performance benchmarks for the matching algorithm.
+
+Run with "python Benchmark.py". Travel times come from the haversine estimator,
+so no API key or network access is needed.
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+import FeatureEngineering as FE
+import MatchingAlgorithm as MA
+from MatrixProviders import HaversineMatrixProvider
+
+def load_simulated_data(num_orders=None, num_phlebs=None, num_catchments=1):
+    orders_df = pd.read_csv("Simulated Data/order_data_1576.csv")
+    phlebs_df = pd.read_csv("Simulated Data/phleb_data_1576.csv")
+    catchments_df = pd.read_csv("Simulated Data/catchment_data_1576.csv")
+    return orders_df.iloc[:num_orders], catchments_df.iloc[:num_catchments], phlebs_df.iloc[:num_phlebs]
+
+def _time_solve(data, time_limit, label, **model_options):
+    """ Solve data with create_routing_model(data, **model_options) under the time limit and print the search done."""
+    manager, routing = MA.create_routing_model(data, **model_options)
+    solutions = []
+    routing.AddAtSolutionCallback(lambda: solutions.append(routing.CostVar().Max()))
+
+    start = time.perf_counter()
+    solution = routing.SolveWithParameters(MA.create_search_parameters(time_limit))
+    elapsed = time.perf_counter() - start
+
+    result = {
+        'seconds': round(elapsed, 2),
+        'solutions': len(solutions),
+        'branches': routing.solver().Branches(),
+        'objective': solution.ObjectiveValue() if solution else None,
+    }
+    print("{:>16}: {}".format(label, result))
+    return result
+
+def benchmark_transit_evaluators(time_limit=30, num_orders=None, num_phlebs=None):
+    """
+    Solve the same instance with Python transit/demand callbacks and with the natively registered
+    matrix, under the same time budget, and compare how much search fits into it.
+    """
+    orders_df, catchments_df, phlebs_df = load_simulated_data(num_orders, num_phlebs)
+    data, _ = MA.prepare_data(orders_df, catchments_df, phlebs_df, HaversineMatrixProvider())
+
+    results = {}
+    for native_evaluators in (False, True):
+        label = 'native matrix' if native_evaluators else 'python callbacks'
+        results[label] = _time_solve(data, time_limit, label, native_evaluators=native_evaluators)
+    return results
+
+def benchmark_arc_pruning(time_limit=10, num_orders=None, num_phlebs=None):
+    """
+    Solve the same instance with and without the time window arc pruning of create_routing_model,
+    under the same time budget.
+    """
+    orders_df, catchments_df, phlebs_df = load_simulated_data(num_orders, num_phlebs)
+    data, _ = MA.prepare_data(orders_df, catchments_df, phlebs_df, HaversineMatrixProvider())
+    arcs, vehicles = MA.infeasible_arc_mask(data)
+    print("pruned {} of {} arcs and {} phlebotomist-order pairs".format(
+        arcs.sum(), arcs.shape[0] * (arcs.shape[1] - 1), vehicles.sum()))
+
+    results = {}
+    for prune_arcs in (False, True):
+        label = 'pruned arcs' if prune_arcs else 'all arcs'
+        results[label] = _time_solve(data, time_limit, label, prune_arcs=prune_arcs)
+    return results
+
+def random_instance(num_orders, num_phlebs, seed=0):
+    """ Synthetic orders and phlebotomists shaped like the simulated data, for scaling benchmarks."""
+    rng = np.random.default_rng(seed)
+    services = ['artTest', 'pathology', 'vaccination']
+    orders_df = pd.DataFrame({'service_' + service: rng.integers(0, 2, num_orders) for service in services})
+    # Every order needs at least one service
+    orders_df.loc[orders_df.sum(axis=1) == 0, 'service_pathology'] = 1
+    phlebs_df = pd.DataFrame({'expertise_' + service: (rng.random(num_phlebs) < 0.7).astype(int) for service in services})
+    return orders_df, phlebs_df
+
+def _apply_expertise_list(orders_df, catchments_df, phlebs_df):
+    """ The previous DataFrame.apply implementation of FE.get_serviceExpertiseConstraint_list, for comparison."""
+    def find_applicable_exp(row):
+        args = np.empty(0)
+        for val in row:
+            args = np.append(args, val)
+        idx = [args == 1]
+        service_needs = service_cols[idx[0]]
+
+        expertiseName = "expertise_{}".format(service_needs[0].split("_")[1])
+        temp = phlebs_df.loc[(phlebs_df[expertiseName] == 1)]
+
+        if len(service_needs) > 1:
+            for service in service_needs[1:]:
+                expertiseName = "expertise_{}".format(service.split("_")[1])
+                temp = temp.loc[(temp[expertiseName] == 1)]  
+        return temp.index.to_list()
+
+    all_columns = orders_df.columns
+    service_cols = all_columns[all_columns.str.contains('service')]
+    return [1] * (phlebs_df.shape[0] + 1) + list(orders_df[service_cols].apply(find_applicable_exp, axis=1))
+
+def benchmark_expertise_constraints(num_orders=10000, num_phlebs=500):
+    """ Time the expertise constraint builder against the previous per-order DataFrame.apply version."""
+    orders_df, phlebs_df = random_instance(num_orders, num_phlebs)
+
+    start = time.perf_counter()
+    expertises = FE.get_serviceExpertiseConstraint_list(orders_df, None, phlebs_df)
+    vectorised = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reference = _apply_expertise_list(orders_df, None, phlebs_df)
+    applied = time.perf_counter() - start
+
+    assert all(list(new) == old for new, old in zip(expertises[num_phlebs + 1:], reference[num_phlebs + 1:]))
+    print("expertise constraints for {} orders x {} phlebotomists: DataFrame.apply {:.2f}s, bitmask {:.3f}s".format(
+        num_orders, num_phlebs, applied, vectorised))
+    return {'apply_seconds': applied, 'bitmask_seconds': vectorised}
+
+
+if __name__ == "__main__":
+    benchmark_transit_evaluators()
+    benchmark_arc_pruning()
+    benchmark_expertise_constraints()
@@ -0,0 +1,166 @@
+"""
+Geographic decomposition of large instances.
+
+A single routing model over every order and phlebotomist in the city scales poorly, so the orders and
+phlebotomists are partitioned into regional clusters, every cluster is solved as its own sub-VRP in a
+separate process, and the routes are stitched back into one output_jsonify-compatible result.
+"""
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import FeatureEngineering as FE
+import MatchingAlgorithm as MA
+
+def _to_addresses(lats, longs):
+    return ['{},{}'.format(lat, long) for lat, long in zip(lats, longs)]
+
+def kmeans(points, num_clusters, num_iterations=50, seed=0):
+    """
+    Plain k-means with k-means++ seeding on (lat, long) points in degrees.
+    Returns the cluster label of every point and the cluster centres.
+    """
+    rng = np.random.default_rng(seed)
+    # Scale longitude so that euclidean distance approximates ground distance at this latitude
+    scale = np.array([1.0, np.cos(np.radians(points[:, 0].mean()))])
+    scaled = points * scale
+
+    centres = [scaled[rng.integers(len(scaled))]]
+    for _ in range(1, num_clusters):
+        squared = ((scaled[:, None, :] - np.array(centres)[None, :, :]) ** 2).sum(axis=2).min(axis=1)
+        if squared.sum() == 0:
+            break
+        centres.append(scaled[rng.choice(len(scaled), p=squared / squared.sum())])
+    centres = np.array(centres)
+
+    for _ in range(num_iterations):
+        labels = ((scaled[:, None, :] - centres[None, :, :]) ** 2).sum(axis=2).argmin(axis=1)
+        new_centres = np.array([scaled[labels == k].mean(axis=0) if (labels == k).any() else centres[k]
+                                for k in range(len(centres))])
+        if np.allclose(new_centres, centres):
+            break
+        centres = new_centres
+    return labels, centres / scale
+
+def partition_instance(orders_df, catchments_df, phlebs_df, method='catchment', num_clusters=None):
+    """
+    Split orders and phlebotomists into regional clusters.
+
+    method: 'catchment' groups every order and phlebotomist around its nearest catchment,
+            'kmeans' clusters the orders by location into num_clusters regions
+    num_clusters: number of k-means regions, defaults to the number of cores (at most one per phlebotomist)
+
+    Returns a list of (order positions, phleb positions, catchment position) per cluster. Every cluster
+    has at least one order and one phlebotomist, and each cluster ends at the catchment nearest to it.
+    """
+    order_addresses = _to_addresses(orders_df['lat'], orders_df['long'])
+    phleb_addresses = _to_addresses(phlebs_df['home_lat'], phlebs_df['home_long'])
+    catchment_addresses = _to_addresses(catchments_df['lat'], catchments_df['long'])
+
+    if method == 'catchment':
+        centre_addresses = catchment_addresses
+        order_labels = FE.haversine_matrix(order_addresses, centre_addresses).argmin(axis=1)
+    elif method == 'kmeans':
+        if num_clusters is None:
+            num_clusters = os.cpu_count() or 1
+        num_clusters = max(1, min(num_clusters, phlebs_df.shape[0], orders_df.shape[0]))
+        order_labels, centres = kmeans(FE.parse_coordinates(order_addresses), num_clusters)
+        centre_addresses = _to_addresses(centres[:, 0], centres[:, 1])
+    else:
+        raise ValueError("Unknown partition method '{}', expected 'catchment' or 'kmeans'".format(method))
+
+    phleb_labels = FE.haversine_matrix(phleb_addresses, centre_addresses).argmin(axis=1)
+    centre_distances = FE.haversine_matrix(centre_addresses)
+    centre_catchments = FE.haversine_matrix(centre_addresses, catchment_addresses).argmin(axis=1)
+
+    # Regions without phlebotomists hand their orders to the nearest region that has some,
+    # then regions without orders hand their phlebotomists to the nearest region with orders.
+    has_phlebs = np.bincount(phleb_labels, minlength=len(centre_addresses)) > 0
+    for k in np.flatnonzero(~has_phlebs):
+        order_labels[order_labels == k] = np.flatnonzero(has_phlebs)[centre_distances[k, has_phlebs].argmin()]
+    has_orders = np.bincount(order_labels, minlength=len(centre_addresses)) > 0
+    for k in np.flatnonzero(~has_orders):
+        phleb_labels[phleb_labels == k] = np.flatnonzero(has_orders)[centre_distances[k, has_orders].argmin()]
+
+    return [(np.flatnonzero(order_labels == k), np.flatnonzero(phleb_labels == k), int(centre_catchments[k]))
+            for k in np.flatnonzero(has_orders)]
+
+def _solve_cluster(orders_df, catchments_df, phlebs_df, api_key, run_options):
+    return MA.run_algorithm(orders_df, catchments_df, phlebs_df, api_key, **run_options)
+
+def stitch_results(results, clusters, orders_df, catchments_df, phlebs_df, encoder='json'):
+    """
+    Merge the per-cluster JSON outputs of run_algorithm into one result over the full instance, serialised with
+    encoder (see MA.encode_output).
+    """
+    metadata = FE.get_metadata(orders_df, catchments_df, phlebs_df)
+    numPhleb = phlebs_df.shape[0]
+    numOrders = orders_df.shape[0]
+    if catchments_df.shape[0] == 1:
+        catchment_nodes = [0]
+    else:
+        catchment_nodes = [1 + numPhleb + numOrders + c for c in range(catchments_df.shape[0])]
+
+    model = {'Objective Number': 0, 'Status': 0, 'Total Revenue Lost': 0, 'Total Number of Nodes Dropped': 0,
+             'Nodes Dropped': [], 'Revenues Dropped': [], 'Total Travel Time': 0, 'Total Loads': 0}
+    routes = []
+    for result, (order_positions, phleb_positions, catchment_position) in zip(results, clusters):
+        if not result.startswith('{'):
+            raise RuntimeError('A cluster could not be solved: ' + result)
+        result = json.loads(result)
+        # Local location index -> location index in the full instance
+        numLocalPhleb = len(phleb_positions)
+        node_map = {0: catchment_nodes[catchment_position]}
+        node_map.update({1 + i: 1 + int(p) for i, p in enumerate(phleb_positions)})
+        node_map.update({1 + numLocalPhleb + i: 1 + numPhleb + int(o) for i, o in enumerate(order_positions)})
+
+        for key in ('Objective Number', 'Total Revenue Lost', 'Total Number of Nodes Dropped',
+                    'Total Travel Time', 'Total Loads'):
+            model[key] += result['Model'][key]
+        model['Status'] = max(model['Status'], result['Model']['Status'])
+        model['Nodes Dropped'].extend(node_map[node] for node in result['Model']['Nodes Dropped'])
+        model['Revenues Dropped'].extend(result['Model']['Revenues Dropped'])
+
+        for route in result['Routes']:
+            route['Phlebotomist Index'] = int(phleb_positions[route['Phlebotomist Index']])
+            route['Locations Sequence'] = [node_map[node] for node in route['Locations Sequence']]
+            if 'Printable Route' in route:
+                route['Printable Route'] = re.sub(
+                    r'(Phlebotomist |Location )(\d+)',
+                    lambda m: m.group(1) + str(route['Phlebotomist Index'] if m.group(1) == 'Phlebotomist '
+                                               else node_map[int(m.group(2))]),
+                    route['Printable Route'])
+            routes.append(route)
+
+    routes.sort(key=lambda route: route['Phlebotomist Index'])
+    return MA.encode_output({'Metadata': metadata, 'Model': model, 'Routes': routes}, encoder)
+
+def solve_decomposed(orders_df, catchments_df, phlebs_df, api_key, method='catchment', num_clusters=None,
+                     processes=None, encoder='json', **run_options):
+    """
+    Solve a city-scale instance as independent regional sub-VRPs, one worker process per cluster.
+
+    method, num_clusters: see partition_instance
+    processes: number of worker processes, defaults to the number of cores
+    encoder: how the stitched output is serialised, see run_algorithm. Clusters always return JSON to be stitched
+    run_options: passed on to run_algorithm for every cluster (matrix_provider, cache, time_limit, ...),
+            they must be picklable
+    Returns the same output as run_algorithm, with indices into the full instance.
+    """
+    clusters = partition_instance(orders_df, catchments_df, phlebs_df, method, num_clusters)
+    run_options = dict(run_options, encoder='json')
+
+    sub_problems = [(orders_df.iloc[order_positions].reset_index(drop=True),
+                     catchments_df.iloc[[catchment_position]].reset_index(drop=True),
+                     phlebs_df.iloc[phleb_positions].reset_index(drop=True))
+                    for order_positions, phleb_positions, catchment_position in clusters]
+
+    with ProcessPoolExecutor(max_workers=max(1, min(processes or os.cpu_count() or 1, len(clusters)))) as executor:
+        futures = [executor.submit(_solve_cluster, cluster_orders, cluster_catchment, cluster_phlebs,
+                                   api_key, run_options)
+                   for cluster_orders, cluster_catchment, cluster_phlebs in sub_problems]
+        results = [future.result() for future in futures]
+
+    return stitch_results(results, clusters, orders_df, catchments_df, phlebs_df, encoder)
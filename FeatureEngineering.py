@@ -1,199 +1,427 @@
 import json
+import os
+import time
+import threading
+import http.client
 import urllib
+import urllib.error
+import urllib.parse
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
-def create_time_matrix(address_list, api):
-    addresses = address_list
+DISTANCE_MATRIX_URL = 'https://maps.googleapis.com/maps/api/distancematrix/json'
+# Number of block requests kept in flight at once; each worker holds its own keep-alive connection.
+MAX_WORKERS = 8
+MAX_RETRIES = 3
+BACKOFF_SECONDS = 0.5
+# Distance Matrix statuses worth retrying, everything else is a hard failure.
+TRANSIENT_STATUSES = {'OVER_QUERY_LIMIT', 'UNKNOWN_ERROR'}
+TRANSIENT_HTTP_CODES = {429, 500, 502, 503, 504}
+# Distance Matrix limits: at most 25 origins, 25 destinations and 100 elements per request.
+MAX_ELEMENTS = 100
+MAX_DIMENSION = 25
+
+
+class TransientRequestError(Exception):
+    """Raised for failures that are worth retrying (5xx, rate limiting, dropped connections)."""
+
+
+def plan_tiles(num_origins, num_destinations, max_elements=MAX_ELEMENTS, max_dimension=MAX_DIMENSION):
+    """
+    Choose the (origins, destinations) block shape that covers a num_origins x num_destinations
+    matrix in the fewest requests, subject to the Distance Matrix limits.
+    Ties are broken towards fewer billed elements, then squarer blocks.
+    """
+    if num_origins == 0 or num_destinations == 0:
+        return (0, 0)
+    best = None
+    for rows in range(1, min(max_dimension, num_origins) + 1):
+        cols = min(max_dimension, num_destinations, max_elements // rows)
+        if cols == 0:
+            break
+        num_requests = -(-num_origins // rows) * -(-num_destinations // cols)
+        key = (num_requests, rows * cols * num_requests, abs(rows - cols))
+        if best is None or key < best[0]:
+            best = (key, (rows, cols))
+    return best[1]
+
+
+def create_time_matrix(address_list, api, max_workers=MAX_WORKERS, base_url=DISTANCE_MATRIX_URL, cache=None,
+                       destinations=None):
+    """
+    Build the travel time matrix (in minutes) between every pair of addresses as an N x N int32 array.
+
+    cache: optional TravelTimeCache, pairs found in it are not requested from the API
+           and newly fetched pairs are written back to it
+    destinations: optional list of destination addresses, the result is then
+           len(address_list) x len(destinations) instead of square
+    """
+    origins = address_list
+    destinations = address_list if destinations is None else list(destinations)
     API_key = api
-    # Distance Matrix API only accepts 100 elements per request, so get rows in multiple requests.
-    # Maximum number of rows that can be computed per request (9 * 9 = 81).
-    max_rows = 9
-    num_addresses = len(addresses)  
-    # num_addresses = q * max_rows + r 
-    q, r = divmod(num_addresses, max_rows)
-    dest_addresses = addresses
-    time_matrix = []
-    for i in range(q):
-        row_time_matrix = []
-        origin_addresses = addresses[i * max_rows: (i + 1) * max_rows]
-        for j in range(q):
-            dest_addresses = addresses[j * max_rows: (j + 1) * max_rows]
-            response = send_request(origin_addresses, dest_addresses, API_key)
-            if len(row_time_matrix) == 0:
-                row_time_matrix += build_time_matrix(response)
-            else:
-                for numRow  in range(len(row_time_matrix)):
-                    row_time_matrix[numRow] += build_time_matrix(response)[numRow]
-        if r > 0:
-            dest_addresses_r = addresses[(q * max_rows): (q * max_rows) + r]
-            response = send_request(origin_addresses, dest_addresses_r, API_key)
-            for numRow  in range(len(row_time_matrix)):
-                    row_time_matrix[numRow] += build_time_matrix(response)[numRow]
-
-        time_matrix += row_time_matrix
-
-    # Get the remaining remaining r rows, if necessary.
-    if r > 0:
-        row_time_matrix = []
-        origin_addresses = addresses[q * max_rows: q * max_rows + r]
-        for j in range(q):
-            dest_addresses = dest_addresses = addresses[j * max_rows: (j + 1) * max_rows]
-            response = send_request(origin_addresses, dest_addresses, API_key)
-            if len(row_time_matrix) == 0:
-                row_time_matrix += build_time_matrix(response)
-            else:
-                for numRow  in range(len(row_time_matrix)):
-                    row_time_matrix[numRow] += build_time_matrix(response)[numRow]
-        
-        dest_addresses_r = addresses[(q * max_rows): (q * max_rows) + r]
-        response = send_request(origin_addresses, dest_addresses_r, API_key)
-        for numRow  in range(len(row_time_matrix)):
-            row_time_matrix[numRow] += build_time_matrix(response)[numRow]
-
-        time_matrix += row_time_matrix
-        
+    # -1 marks pairs that still have to be fetched
+    time_matrix = np.full((len(origins), len(destinations)), -1, dtype=np.int32)
+
+    if cache is not None:
+        cached = cache.get_many(origins, destinations)
+        for i, origin in enumerate(origins):
+            for j, dest in enumerate(destinations):
+                minutes = cached.get((origin, dest))
+                if minutes is not None:
+                    time_matrix[i, j] = minutes
+
+    # Group origins by the destinations they are missing, so that a few new locations
+    # only cost their own rows and columns instead of a full refetch.
+    missing_mask = time_matrix < 0
+    missing_groups = {}
+    for i in np.flatnonzero(missing_mask.any(axis=1)):
+        missing_groups.setdefault(missing_mask[i].tobytes(), []).append(i)
+
+    blocks = []
+    for origin_idx in missing_groups.values():
+        origin_idx = np.array(origin_idx)
+        dest_idx = np.flatnonzero(missing_mask[origin_idx[0]])
+        # Distance Matrix API only accepts 100 elements per request, so tile the missing
+        # sub-matrix with the block shape that needs the fewest requests.
+        rows, cols = plan_tiles(len(origin_idx), len(dest_idx))
+        for o in range(0, len(origin_idx), rows):
+            for d in range(0, len(dest_idx), cols):
+                blocks.append((origin_idx[o: o + rows], dest_idx[d: d + cols]))
+
+    def fetch_block(block):
+        origin_idx, dest_idx = block
+        origin_addresses = [origins[i] for i in origin_idx]
+        dest_addresses = [destinations[j] for j in dest_idx]
+        return build_time_matrix(send_request(origin_addresses, dest_addresses, API_key, base_url))
+
+    if blocks:
+        # Blocks are fetched concurrently and each parsed response is written into
+        # its slot of the preallocated matrix exactly once.
+        # The worker threads outlive the call so their keep-alive connections are reused by the next one.
+        executor = _get_executor(max(1, max_workers))
+        for (origin_idx, dest_idx), block_matrix in zip(blocks, executor.map(fetch_block, blocks)):
+            time_matrix[np.ix_(origin_idx, dest_idx)] = block_matrix
+        if cache is not None:
+            fetched = {}
+            for origin_idx, dest_idx in blocks:
+                for i in origin_idx:
+                    for j in dest_idx:
+                        fetched[(origins[i], destinations[j])] = int(time_matrix[i, j])
+            cache.put_many(fetched)
+
     return time_matrix
 
 
-def send_request(origin_addresses, dest_addresses, API_key):
-    """ Build and send request for the given origin and destination addresses."""
+_connections = threading.local()
+_executors = {}
+_executors_lock = threading.Lock()
+
+def _get_executor(max_workers):
+    """ Return the shared pool of request threads of the given size, creating it on first use."""
+    with _executors_lock:
+        # A forked worker process inherits the pools but not their threads, so it starts its own
+        key = (os.getpid(), max_workers)
+        if key not in _executors:
+            _executors[key] = ThreadPoolExecutor(max_workers=max_workers,
+                                                 thread_name_prefix='distance-matrix')
+        return _executors[key]
+
+def _get_connection(scheme, netloc):
+    """ Return this thread's keep-alive connection to the given host, opening one if needed."""
+    pool = getattr(_connections, 'pool', None)
+    if pool is None:
+        pool = _connections.pool = {}
+    key = (scheme, netloc)
+    if key not in pool:
+        connection_cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        pool[key] = connection_cls(netloc, timeout=30)
+    return pool[key]
+
+def _drop_connection(scheme, netloc):
+    pool = getattr(_connections, 'pool', {})
+    connection = pool.pop((scheme, netloc), None)
+    if connection is not None:
+        connection.close()
+
+def _get_json(url):
+    """ GET the url over a pooled connection and decode the JSON body."""
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path + ('?' + parts.query if parts.query else '')
+    connection = _get_connection(parts.scheme, parts.netloc)
+    try:
+        connection.request('GET', path)
+        res = connection.getresponse()
+        body = res.read()
+    except (http.client.HTTPException, OSError) as e:
+        # Server closed the keep-alive socket or the network dropped, reconnect on the next attempt
+        _drop_connection(parts.scheme, parts.netloc)
+        raise TransientRequestError(str(e)) from e
+
+    if res.status in TRANSIENT_HTTP_CODES:
+        raise TransientRequestError('HTTP {}'.format(res.status))
+    if res.status != 200:
+        raise urllib.error.HTTPError(url, res.status, res.reason, res.headers, None)
+
+    response = json.loads(body)
+    if response.get('status') in TRANSIENT_STATUSES:
+        raise TransientRequestError(response['status'])
+    return response
+
+def send_request(origin_addresses, dest_addresses, API_key, base_url=DISTANCE_MATRIX_URL,
+                 max_retries=MAX_RETRIES, backoff=BACKOFF_SECONDS):
+    """ Build and send request for the given origin and destination addresses.
+
+    Transient failures are retried with exponential backoff (backoff, 2*backoff, ...).
+    """
     def build_address_str(addresses):
         # Build a pipe-separated string of addresses
-        address_str = ''
-        if len(addresses) > 1:
-            for i in range(len(addresses) - 1):
-                address_str += addresses[i] + '|'
-            
-            address_str += addresses[-1]
-        else:
-            address_str = addresses[0]
-        return address_str
+        return urllib.parse.quote('|'.join(addresses), safe=',|')
 
-    request = 'https://maps.googleapis.com/maps/api/distancematrix/json?units=metric'
     origin_address_str = build_address_str(origin_addresses)
     dest_address_str = build_address_str(dest_addresses)
-    request = request + '&origins=' + origin_address_str + '&destinations=' + \
+    request = base_url + '?units=metric' + '&origins=' + origin_address_str + '&destinations=' + \
         dest_address_str + '&key=' + API_key
-    
-    with urllib.request.urlopen(request) as url:
-        jsonResult = url.read()
-        response = json.loads(jsonResult)
-        return response
+
+    for attempt in range(max_retries + 1):
+        try:
+            return _get_json(request)
+        except TransientRequestError:
+            if attempt == max_retries:
+                raise
+            time.sleep(backoff * (2 ** attempt))
 
 def secondsToMinutes(seconds):
     return int(seconds/60)
 
 def build_time_matrix(response):
-    time_matrix = []
-    for row in response['rows']:
-        row_list = [secondsToMinutes(row['elements'][j]['duration']['value'])
-                    for j in range(len(row['elements']))]
-        time_matrix.append(row_list)
-    return time_matrix
+    """ Parse a Distance Matrix response into an origins x destinations int32 array of minutes."""
+    seconds = np.array([[element['duration']['value'] for element in row['elements']]
+                        for row in response['rows']], dtype=np.int64)
+    return (seconds // 60).astype(np.int32)
+
+
+'''
+Approximate Travel Times
+'''
+
+EARTH_RADIUS_KM = 6371.0088
+# Minutes per straight-line km and fixed minutes per trip, a rough urban default
+# (about 25 km/h on roads 1.3x longer than the crow flies). Use fit_speed_factors to calibrate.
+DEFAULT_MINUTES_PER_KM = 3.1
+DEFAULT_BASE_MINUTES = 2.0
+
+def parse_coordinates(address_list):
+    """ Convert "lat,long" address strings into an N x 2 float array of (lat, long) in degrees."""
+    return np.array([address.split(',') for address in address_list], dtype=float).reshape(-1, 2)
+
+def haversine_matrix(origins, destinations=None):
+    """ Great-circle distances in km between every origin and destination "lat,long" address."""
+    origin_rad = np.radians(parse_coordinates(origins))
+    dest_rad = origin_rad if destinations is None else np.radians(parse_coordinates(destinations))
+
+    lat1, long1 = origin_rad[:, 0, None], origin_rad[:, 1, None]
+    lat2, long2 = dest_rad[None, :, 0], dest_rad[None, :, 1]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((long2 - long1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def estimate_time_matrix(origins, destinations=None, minutes_per_km=DEFAULT_MINUTES_PER_KM,
+                         base_minutes=DEFAULT_BASE_MINUTES):
+    """
+    Approximate travel time matrix in minutes, computed in one NumPy broadcast as
+    base_minutes + minutes_per_km * haversine distance (0 between identical locations).
+    Same int32 layout as create_time_matrix, for what-if runs and very large instances.
+    """
+    distances = haversine_matrix(origins, destinations)
+    minutes = np.where(distances > 0, base_minutes + minutes_per_km * distances, 0)
+    return minutes.astype(np.int32)
+
+def fit_speed_factors(address_list, time_matrix, destinations=None):
+    """
+    Calibrate estimate_time_matrix against a previously fetched matrix by least squares.
+    Returns (minutes_per_km, base_minutes).
+    """
+    distances = haversine_matrix(address_list, destinations)
+    time_matrix = np.asarray(time_matrix, dtype=float)
+    pairs = distances > 0
+    if pairs.sum() < 2:
+        return DEFAULT_MINUTES_PER_KM, DEFAULT_BASE_MINUTES
+    design = np.column_stack((distances[pairs], np.ones(pairs.sum())))
+    (minutes_per_km, base_minutes), *_ = np.linalg.lstsq(design, time_matrix[pairs], rcond=None)
+    if base_minutes < 0:
+        # A negative base time is not physical, refit the slope alone with the base time fixed at 0
+        (minutes_per_km,), *_ = np.linalg.lstsq(design[:, :1], time_matrix[pairs], rcond=None)
+        base_minutes = 0.0
+    return float(minutes_per_km), float(base_minutes)
 
 
 '''
 Other Preprocessing Codes
 '''
 
+# The vehicle fixed cost is the rating shortfall from 5 stars in tenths of a star, since OR-Tools costs are integers
+RATING_COST_SCALE = 10
+
+class ProblemInstance:
+    """
+    Every per-location and per-phlebotomist input of the routing model, built in one pass over the DataFrames
+    (see build_problem_instance) and held in compact NumPy arrays.
+
+    Location arrays follow the node layout of the routing model: index 0 is the ending catchment (or a placeholder
+    in the multi-ends version), then the M phlebotomists' starting locations, then the orders.
+
+    time_windows: (nodes x 2) int32 minutes of the day, index 0 is the break time window
+    servicing_times: int32 minutes spent at every node, 0 for the catchment and starting locations
+    revenues: int32 price of every order, 1 for the catchment and starting locations
+    inverse_ratings: int32 vehicle fixed cost per phlebotomist, (5 - rating) * RATING_COST_SCALE
+    expertise_mask: (orders x phlebotomists) bool, True where the phlebotomist can serve the order
+    coordinates: (catchments + phlebotomists + orders) x 2 float (lat, long), in the order of addresses
+    addresses: "lat,long" strings in the order of get_coordinates_list (catchments, phlebotomists, orders)
+    """
+    __slots__ = ('num_catchments', 'num_phlebs', 'num_orders', 'order_ids', 'phleb_ids', 'addresses', 'coordinates',
+                 'time_windows', 'servicing_times', 'revenues', 'inverse_ratings', 'expertise_mask')
+
+    def __init__(self, num_catchments, num_phlebs, num_orders, order_ids, phleb_ids, addresses, coordinates,
+                 time_windows, servicing_times, revenues, inverse_ratings, expertise_mask):
+        self.num_catchments = num_catchments
+        self.num_phlebs = num_phlebs
+        self.num_orders = num_orders
+        self.order_ids = order_ids
+        self.phleb_ids = phleb_ids
+        self.addresses = addresses
+        self.coordinates = coordinates
+        self.time_windows = time_windows
+        self.servicing_times = servicing_times
+        self.revenues = revenues
+        self.inverse_ratings = inverse_ratings
+        self.expertise_mask = expertise_mask
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @property
+    def num_nodes(self):
+        return 1 + self.num_phlebs + self.num_orders
+
+    @property
+    def catchment_addresses(self):
+        return self.addresses[:self.num_catchments]
+
+    @property
+    def location_addresses(self):
+        """ Phlebotomists' and orders' addresses, nodes 1 onwards of the routing model."""
+        return self.addresses[self.num_catchments:]
+
+    def location_coordinates(self):
+        """ (lat, long) of every Location Index of get_metadata, NaN for the multi-ends placeholder."""
+        if self.num_catchments == 1:
+            return self.coordinates
+        return np.vstack((np.full((1, 2), np.nan), self.coordinates[self.num_catchments:],
+                          self.coordinates[:self.num_catchments]))
+
+    def get_metadata(self):
+        """ The 'Metadata' section of the output, see get_metadata."""
+        order_ids = ["Starting Location" for _ in range(self.num_phlebs)]
+        order_ids.extend(str(order_id) for order_id in self.order_ids)
+        if self.num_catchments == 1:
+            order_ids = ["Ending Location"] + order_ids
+            addresses_list = self.addresses
+        else:
+            # Index 0 is a trivial placeholder and the ending catchments go to the end instead
+            order_ids = ["Placeholder"] + order_ids + ["Ending Location" for _ in range(self.num_catchments)]
+            addresses_list = ["Placeholder"] + self.location_addresses + self.catchment_addresses
+
+        metadata = {'Locations': [{"Location Index": idx, "Coordinate": coordinate, "Order Id": order_id}
+                                  for idx, (coordinate, order_id) in enumerate(zip(addresses_list, order_ids))]}
+        metadata['Phlebotomists'] = [{"Phlebotomist Index": idx, "Id": id} for idx, id in enumerate(self.phleb_ids)]
+        return metadata
+
+def _address_column(lats, longs):
+    return (lats.astype(str) + ',' + longs.astype(str)).tolist()
+
+def build_problem_instance(orders_df, catchments_df, phlebs_df):
+    """ Read every input of the routing model out of the DataFrames in one pass, see ProblemInstance."""
+    numCatchment = catchments_df.shape[0]
+    numPhleb = phlebs_df.shape[0]
+    numOrders = orders_df.shape[0]
+
+    addresses = _address_column(catchments_df['lat'], catchments_df['long'])
+    addresses.extend(_address_column(phlebs_df['home_lat'], phlebs_df['home_long']))
+    addresses.extend(_address_column(orders_df['lat'], orders_df['long']))
+    coordinates = np.vstack((catchments_df[['lat', 'long']].to_numpy(dtype=float),
+                             phlebs_df[['home_lat', 'home_long']].to_numpy(dtype=float),
+                             orders_df[['lat', 'long']].to_numpy(dtype=float)))
+
+    starts = np.empty(1 + numPhleb + numOrders, dtype=np.int32)
+    starts[0] = 6 #ending depot, the window is the break time 6:00 to 18:00
+    starts[1:1 + numPhleb] = phlebs_df['shift_start'].to_numpy()
+    starts[1 + numPhleb:] = orders_df['order_start'].to_numpy()
+    time_windows = np.column_stack((starts * 60, (starts + 1) * 60))
+    time_windows[0, 1] = 18 * 60
+
+    servicing_times = np.zeros(1 + numPhleb + numOrders, dtype=np.int32)
+    servicing_times[1 + numPhleb:] = orders_df['duration'].to_numpy() + orders_df['buffer'].to_numpy()
+
+    revenues = np.ones(1 + numPhleb + numOrders, dtype=np.int32)
+    revenues[1 + numPhleb:] = np.rint(orders_df['price'].to_numpy(dtype=float))
+
+    inverse_ratings = np.rint((5 - phlebs_df['service_rating'].to_numpy(dtype=float)) * RATING_COST_SCALE).astype(np.int32)
+
+    return ProblemInstance(numCatchment, numPhleb, numOrders, orders_df['order_id'].tolist(),
+                           phlebs_df['phleb_id'].tolist(), addresses, coordinates, time_windows.astype(np.int32),
+                           servicing_times, revenues, inverse_ratings,
+                           get_expertise_compatibility(orders_df, phlebs_df))
+
+# The functions below return single inputs in their original list formats and are kept for the notebooks,
+# the matching algorithm itself uses build_problem_instance.
+
 def get_coordinates_list(orders_df, catchments_df, phlebs_df):
-    orders_df = orders_df.astype({'long': str, 'lat': str})
-    catchments_df = catchments_df.astype({'long': str, 'lat': str})
-    phlebs_df = phlebs_df.astype({'home_long': str, 'home_lat': str})
-    
-    orders_df['Address'] = orders_df['lat'].str.cat(orders_df['long'], sep=',')
-    catchments_df['Address'] = catchments_df['lat'].str.cat(catchments_df['long'], sep=',')
-    phlebs_df['Address'] = phlebs_df['home_lat'].str.cat(phlebs_df['home_long'], sep=',')
-
-    addresses_list = []
-    if catchments_df.shape[0] == 1:
-        addresses_list.append(catchments_df['Address'].iloc[0])
-        #Phlebotomists' Starting Points second
-        addresses_list.extend(phlebs_df['Address'])
-        #Orders' Locations last
-        addresses_list.extend(orders_df['Address'])
-    else:
-        addresses_list.extend(catchments_df['Address'])
-        addresses_list.extend(phlebs_df['Address'])
-        addresses_list.extend(orders_df['Address'])
-        
-    return addresses_list
+    return (_address_column(catchments_df['lat'], catchments_df['long'])
+            + _address_column(phlebs_df['home_lat'], phlebs_df['home_long'])
+            + _address_column(orders_df['lat'], orders_df['long']))
 
 def get_timeWindows_list(orders_df, catchments_df, phlebs_df):
-    time_window = [(6 * 60, 18 * 60)] #ending depot
-    time_window.extend([(int(start) * 60, (int(start)+1) * 60) for start in phlebs_df['shift_start']])
-    time_window.extend([(int(start) * 60, int(start+1) * 60) for start in orders_df['order_start']])
-    return time_window
+    instance = build_problem_instance(orders_df, catchments_df, phlebs_df)
+    return [tuple(window) for window in instance.time_windows.tolist()]
 
 def get_servicingTimes_list(orders_df, catchments_df, phlebs_df):
-    numPhleb = phlebs_df.shape[0]
-    servicing_times = [0]
-    servicing_times.extend([0 for _ in range(numPhleb)])
-    servicing_times.extend(orders_df['duration'] + orders_df['buffer'])
-    return servicing_times
+    return build_problem_instance(orders_df, catchments_df, phlebs_df).servicing_times.tolist()
 
 def get_inverseRatings_list(orders_df, catchments_df, phlebs_df):
-    inverse_ratings = 5 - phlebs_df['service_rating']
-    return inverse_ratings
+    return 5 - phlebs_df['service_rating']
 
 def get_orderRevenues_list(orders_df, catchments_df, phlebs_df):
-    numPhleb = phlebs_df.shape[0]
-    revenues = [1] #ending depot
-    revenues.extend([1 for _ in range(numPhleb)])
-    revenues.extend(orders_df['price'])
-    return revenues
+    return build_problem_instance(orders_df, catchments_df, phlebs_df).revenues.tolist()
 
-def get_serviceExpertiseConstraint_list(orders_df, catchments_df, phlebs_df):
-    def find_applicable_exp(row):
-        args = np.empty(0)
-        for val in row:
-            args = np.append(args, val)
-        idx = [args == 1]
-        service_needs = service_cols[idx[0]]
-
-        expertiseName = "expertise_{}".format(service_needs[0].split("_")[1])
-        temp = phlebs_df.loc[(phlebs_df[expertiseName] == 1)]
-
-        if len(service_needs) > 1:
-            for service in service_needs[1:]:
-                expertiseName = "expertise_{}".format(service.split("_")[1])
-                temp = temp.loc[(temp[expertiseName] == 1)]  
-        return temp.index.to_list()
-    
-    numPhleb = phlebs_df.shape[0]
+def get_expertise_compatibility(orders_df, phlebs_df):
+    """
+    Boolean matrix of shape (orders, phlebotomists), True where the phlebotomist has the expertise
+    for every service the order needs (columns service_X in orders_df and expertise_X in phlebs_df).
+    """
     all_columns = orders_df.columns
     service_cols = all_columns[all_columns.str.contains('service')]
-    orders_df['Acceptable Phleb Indices'] = orders_df[service_cols].apply(find_applicable_exp, axis=1)
+    expertise_cols = ["expertise_{}".format(service.split("_")[1]) for service in service_cols]
+
+    # One bit per service, an order fits a phlebotomist if it needs no bit the phlebotomist lacks
+    bits = np.left_shift(np.int64(1), np.arange(len(service_cols), dtype=np.int64))
+    needs = (orders_df[service_cols].to_numpy() == 1) @ bits
+    skills = (phlebs_df[expertise_cols].to_numpy() == 1) @ bits
+    return (needs[:, None] & ~skills[None, :]) == 0
+
+def get_serviceExpertiseConstraint_list(orders_df, catchments_df, phlebs_df):
+    numPhleb = phlebs_df.shape[0]
+    compatible = get_expertise_compatibility(orders_df, phlebs_df)
     expertises = [1] #ending depot
     expertises.extend([1 for _ in range(numPhleb)])
-    expertises.extend(orders_df['Acceptable Phleb Indices'])
+    # Positions of the acceptable phlebotomists (vehicle ids) for every order
+    expertises.extend(np.flatnonzero(row) for row in compatible)
     return expertises
 
 def get_metadata(orders_df, catchments_df, phlebs_df):
-    numPhleb = phlebs_df.shape[0]
-    numCatchment = catchments_df.shape[0]
-
-    #If there is only 1 catchment area, we will put it in the Front
-    if catchments_df.shape[0] == 1:
-        order_ids = ["Ending Location"] #ending catchment
-        order_ids.extend(["Starting Location" for _ in range(numPhleb)])
-        order_ids.extend(orders_df['order_id'])
-        addresses_list = get_coordinates_list(orders_df, catchments_df, phlebs_df)
-        locations_metadata = zip(addresses_list, order_ids)
-        metadata = {'Locations': [{"Location Index": idx, "Coordinate": metadata[0], "Order Id": str(metadata[1])}for idx, metadata in enumerate(locations_metadata)]}
-        metadata['Phlebotomists'] = [{"Phlebotomist Index": idx, "Id": id}for idx, id in enumerate(phlebs_df['phleb_id'])]
-    else:
-    #If there more than 1 catchment area, index 0 will just be a trivial placeholder, so not to disrupt other inputs' format, 
-    # and we will add ending catchments to the End instead
-        order_ids = ["Placeholder"]
-        order_ids.extend(["Starting Location" for _ in range(numPhleb)])
-        order_ids.extend(orders_df['order_id'])
-        order_ids.extend(["Ending Location" for _ in range(numCatchment)]) #catchment areas
-        addresses_list = ["Placeholder"]
-        addresses_list.extend(get_coordinates_list(orders_df, catchments_df, phlebs_df))
-        locations_metadata = zip(addresses_list, order_ids)
-        metadata = {'Locations': [{"Location Index": idx, "Coordinate": metadata[0], "Order Id": str(metadata[1])}for idx, metadata in enumerate(locations_metadata)]}
-        metadata['Phlebotomists'] = [{"Phlebotomist Index": idx, "Id": id}for idx, id in enumerate(phlebs_df['phleb_id'])]
-    
-    return metadata
\ No newline at end of file
+    #If there is only 1 catchment area, it is put in the Front. If there more than 1 catchment area, index 0 will
+    # just be a trivial placeholder, so not to disrupt other inputs' format, and the ending catchments are added to the End instead
+    return build_problem_instance(orders_df, catchments_df, phlebs_df).get_metadata()
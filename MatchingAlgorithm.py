@@ -1,67 +1,81 @@
 from ortools.constraint_solver import routing_enums_pb2
 from ortools.constraint_solver import pywrapcp
 import FeatureEngineering as FE
+from MatrixProviders import GoogleMatrixProvider
 import numpy as np
 import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 
-def create_data_model(time_matrix, time_window, revenues, num_vehicles, servicing_times, inverse_ratings, expertiseConstraints, metadata):
+def create_data_model(instance, time_matrix):
     """
     Purpose of this function is to store the data for the problem.
 
+    instance: FE.ProblemInstance holding the time windows, servicing times, revenues, ratings and expertise
+            of every location and phlebotomist, in the node layout of the time matrix
     time_matrix: A 2-d Array of Travel times between locations. Format is specified in Feature Engineering.py file
-
-    time_window: An array of time window tuples for each locations, requested times for the visit that MUST be fulfilled.
-                Format = [(X, X+60) ... (N, N+60)]
-                Note that at Index 0, it is the ending/pickup location, time window is set to the Break Time
-                and for Index 1 to  M (where M is the number of Phlebotomists), those are phlebotomists' starting locations
-                therefore time windows are set based on their starting time
-    
-    revenues: A 1-d Array of revenues of each orders/order locations
-            Format = [1 ... N]
-            Note that at Index 0, it is the ending/pickup location, revenue is set arbitrarily at $1 
-            and for Index 1 to  M (where M is the number of Phlebotomists), those are phlebotomists' starting locations
-            revenue is also set arbitrarily at $1. However, those values are trivial and will not affect the algorithm
-    
-    num_vehicles: A single digit for the number of Phlebotomists available for allocation
-
-    servicing_times: An 1-d array for each order's servicing time required. Note that from Index 0 to M phlebotomists of the array
-            trivial, so can just set any arbritrary number (e.g. 0).
-
-    expertiseConstaints: An array consisting of N-Length arrays where N is the number of Vehicles/Phlebotomists 
-            with the relevant expertise required for the location at the index of the array. 
-            Format = [1 ... [0, 1 ... N] ...]
-            Note that from Index 0 to M (where M is the number of Phlebotomists), the values are trivial, so can just set any arbritrary number (e.g. 1).
     """
     data = {}
 
-    data['metadata'] = metadata
+    data['instance'] = instance
+    data['metadata'] = instance.get_metadata()
 
-    data['inverse_ratings'] = inverse_ratings
+    data['inverse_ratings'] = instance.inverse_ratings
 
     #Important! To ensure Revenue Lost is larger than overall transit time in order to ensure the "penalty" is effective during optimization routing
-    data['revenue_potential'] = [int(revenue * np.sum(time_matrix[1])) for revenue in revenues] 
-    
-    time_matrix_np = np.array(time_matrix)
+    data['revenue_scale'] = int(np.sum(time_matrix[1]))
+    data['revenue_potential'] = instance.revenues.astype(np.int64) * data['revenue_scale']
+
     # Take into account of servicing times
-    for col_idx in range(len(servicing_times)):
-        time_matrix_np[:, col_idx] += servicing_times[col_idx]
-    
+    time_matrix_np = np.array(time_matrix) + instance.servicing_times[None, :]
+
     data['time_matrix'] = time_matrix_np
+    data['num_locations'] = len(time_matrix_np)
 
-    data['time_windows'] = time_window
+    data['time_windows'] = instance.time_windows
 
+    num_vehicles = instance.num_phlebs
     data['num_vehicles'] = num_vehicles
     data['starts'] = [i for i in range(1, num_vehicles+1)] #start locations
     data['ends'] = [0 for _ in range(num_vehicles)] #end location
     
-    data['demands'] = [1 if _ > num_vehicles else 0 for _ in range(1, len(time_matrix) + 1)] 
+    data['demands'] = (np.arange(len(time_matrix_np)) > num_vehicles).astype(np.int32)
     data['vehicle_capacities'] = [20 for _ in range(num_vehicles)]
-    data['servicing_times'] = servicing_times
+    data['servicing_times'] = instance.servicing_times
 
-    data['expertises'] = expertiseConstraints
+    # Orders x phlebotomists, True where the phlebotomist has the expertise the order needs
+    data['expertise_mask'] = instance.expertise_mask
 
     return data
 
+def add_catchment_ends(data, catchment_times):
+    """
+    Model every catchment as a real end node for the multi-ends version, so the solver optimises the return leg.
+
+    Each vehicle gets its own copy of every catchment node (a node can only be visited once), appended after the
+    data's locations. Exactly one copy per used vehicle is visited, right before the vehicle's end at node 0,
+    which is a placeholder with zero travel time from the copies (see create_routing_model).
+
+    catchment_times: num_locations x numCatchments travel times from every location to every catchment
+    """
+    num_locations = data['num_locations']
+    end_copies = [(vehicle_id, c) for vehicle_id in range(data['num_vehicles']) for c in range(catchment_times.shape[1])]
+    copy_catchments = np.array([c for _, c in end_copies], dtype=int)
+
+    size = num_locations + len(end_copies)
+    time_matrix = np.zeros((size, size), dtype=data['time_matrix'].dtype)
+    time_matrix[:num_locations, :num_locations] = data['time_matrix']
+    time_matrix[:num_locations, num_locations:] = catchment_times[:, copy_catchments]
+
+    data['time_matrix'] = time_matrix
+    data['end_copies'] = end_copies
+    data['servicing_times'] = np.concatenate((data['servicing_times'], np.zeros(len(end_copies), dtype=np.int32)))
+    data['demands'] = np.concatenate((data['demands'], np.zeros(len(end_copies), dtype=np.int32)))
+    # Location Index in the metadata of every node, the catchments follow the orders there
+    data['node_locations'] = list(range(num_locations)) + [num_locations + int(c) for c in copy_catchments]
+    return data
+
 class npEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, np.int32):
@@ -70,246 +84,245 @@ class npEncoder(json.JSONEncoder):
             return int(obj)
         return json.JSONEncoder.default(self, obj)
 
-def output_jsonify(data, manager, routing, solution):
-    
-    output = {}
-    metadata = data['metadata']
-    output['Metadata'] = metadata
+def extract_solution(data, manager, routing, solution, catchments_coordinates=None, matrix_provider=None):
+    """
+    Walk the solution once and collect it into flat NumPy arrays, for build_output and the other exports.
 
-    model = {}
-    routes = []
+    Every route's stops are stored one after the other, route_offsets[v]:route_offsets[v + 1] being the stops of
+    vehicle v, the last of which is where the route ends. Times are the min and max of the time cumul, start times
+    are before the servicing and slack is 0 at the end.
 
-    model['Objective Number'] = solution.ObjectiveValue()
-    model['Status'] = routing.status()
+    catchments_coordinates, matrix_provider: only for the multi-ends version without catchment end nodes
+            (see prepare_data), where every route is sent to the catchment nearest its last stop. The travel times
+            are taken from data['catchment_times'] when present, otherwise they are requested from matrix_provider
+            in one batched origins x catchments call for all routes.
+    """
+    # Catchment end copies of the multi-ends version are reported by their catchment's Location Index
+    num_locations = data.get('num_locations', len(data['time_matrix']))
+    node_locations = np.asarray(data.get('node_locations', range(len(data['time_matrix']))))
+    has_catchment_ends = bool(data.get('end_copies'))
+    nearest_catchment_ends = catchments_coordinates is not None or 'catchment_times' in data
+    time_matrix = np.asarray(data['time_matrix'])
+    servicing_times = np.asarray(data['servicing_times'])
 
     # Dropped Nodes/Customers
-    total_revenue_lost = 0
-    total_node_drops = 0
-    dropped_nodes = []
-    dropped_revenues = []
-    for node in range(routing.Size()):
-        if routing.IsStart(node) or routing.IsEnd(node):
-            continue
-        if solution.Value(routing.NextVar(node)) == node:
-            dropped_nodes.append(manager.IndexToNode(node))
-            dropped_revenues.append(data['revenue_potential'][manager.IndexToNode(node)] / sum(data['time_matrix'][0]))  #Get back the actual Revenue Lost
-            total_revenue_lost += data['revenue_potential'][manager.IndexToNode(node)] / sum(data['time_matrix'][0])
-            total_node_drops += 1
-    
-    model['Total Revenue Lost'] = total_revenue_lost
-    model["Total Number of Nodes Dropped"] = total_node_drops
-    model["Nodes Dropped"] = dropped_nodes
-    model["Revenues Dropped"] = dropped_revenues
-    
+    dropped_nodes = np.array([manager.IndexToNode(index) for index in range(routing.Size())
+                              if not routing.IsStart(index) and not routing.IsEnd(index)
+                              and manager.IndexToNode(index) < num_locations
+                              and solution.Value(routing.NextVar(index)) == index], dtype=np.int64)
 
     # Routes
     time_dimension = routing.GetDimensionOrDie('Time')
-    total_time = 0
-    total_load = 0
+    nodes, cumul_min, cumul_max, slack_min, slack_max = [], [], [], [], []
+    route_offsets = [0]
     for vehicle_id in range(data['num_vehicles']):
         index = routing.Start(vehicle_id)
-        prev_index = 0
-
-        phleb_route = {}
-        route_locations = []
-        route_startTimes =[]
-        route_endTimes = []
-        route_slackTimes = []
-        phleb_route['Phlebotomist Index'] = vehicle_id
-
-        plan_output = 'Route for Phlebotomist {}:\n'.format(vehicle_id)
-
-        route_load = 0
-        total_transit_time = 0 
-        while not routing.IsEnd(index):
+        while True:
+            node_index = manager.IndexToNode(index)
             time_var = time_dimension.CumulVar(index)
+            nodes.append(node_index)
+            cumul_min.append(solution.Min(time_var))
+            cumul_max.append(solution.Max(time_var))
+            if routing.IsEnd(index) or node_index >= num_locations:
+                # Routing end, or the catchment end copy the route ends at
+                slack_min.append(0)
+                slack_max.append(0)
+                break
             slack_var = time_dimension.SlackVar(index)
-
-            node_index = manager.IndexToNode(index)
-            route_load += data['demands'][node_index]
-
-            plan_output += 'Location {0} Start({1},{2}) End({3}, {4}) -> Slack({5}, {6}) -> '.format(
-                manager.IndexToNode(index), 
-                solution.Min(time_var) - data['servicing_times'][node_index], solution.Max(time_var) - data['servicing_times'][node_index],
-                solution.Min(time_var) , solution.Max(time_var),
-                solution.Min(slack_var), solution.Max(slack_var))
-            
-            route_locations.append(manager.IndexToNode(index))
-            route_startTimes.append((solution.Min(time_var) - data['servicing_times'][node_index], solution.Max(time_var) - data['servicing_times'][node_index]))
-            route_endTimes.append((solution.Min(time_var) , solution.Max(time_var)))
-            route_slackTimes.append((solution.Min(slack_var), solution.Max(slack_var)))
-            
-            prev_index = index
+            slack_min.append(solution.Min(slack_var))
+            slack_max.append(solution.Max(slack_var))
             index = solution.Value(routing.NextVar(index))
-      
-            total_transit_time = total_transit_time + data['time_matrix'][manager.IndexToNode(prev_index)][manager.IndexToNode(index)] - data['servicing_times'][manager.IndexToNode(index)]
-
-        total_time += total_transit_time
-        time_var = time_dimension.CumulVar(index)
-
-        plan_output += 'Location {0} Time({1},{2})\n'.format(manager.IndexToNode(index),
-                                                    solution.Min(time_var),
-                                                    solution.Max(time_var))
-        
-        route_locations.append(manager.IndexToNode(index))
-        route_startTimes.append((solution.Min(time_var),  solution.Max(time_var)))
-        route_endTimes.append((solution.Min(time_var) , solution.Max(time_var)))
-
-        phleb_route['Printable Route'] = plan_output
-        phleb_route['Total Travel Time'] = total_transit_time
-        phleb_route['Total Loads'] = route_load
-        phleb_route['Locations Sequence'] = route_locations
-        phleb_route['Start Times Sequence'] = route_startTimes
-        phleb_route['End Times Sequence'] = route_endTimes
-        phleb_route['Slack Times Sequence'] = route_slackTimes
-
-        routes.append(phleb_route)
-
-        total_load += route_load
-    
-    model['Total Travel Time'] = total_time
-    model['Total Loads'] = total_load
-
-    output['Model'] = model
-    output['Routes'] = routes
-
-    return json.dumps(output, indent=2, cls=npEncoder)
+        route_offsets.append(len(nodes))
+
+    nodes = np.array(nodes, dtype=np.int64)
+    route_offsets = np.array(route_offsets, dtype=np.int64)
+    cumul_min = np.array(cumul_min, dtype=np.int64)
+    cumul_max = np.array(cumul_max, dtype=np.int64)
+    is_end = np.zeros(len(nodes), dtype=bool)
+    is_end[route_offsets[1:] - 1] = True
+
+    start_min = cumul_min - np.where(is_end, 0, servicing_times[nodes])
+    start_max = cumul_max - np.where(is_end, 0, servicing_times[nodes])
+    locations = node_locations[nodes]
+
+    # Travel time of every leg is the transit minus the servicing at its destination
+    legs = time_matrix[nodes[:-1], nodes[1:]] - servicing_times[nodes[1:]]
+    legs[is_end[:-1]] = 0 # no leg from one route's end to the next route's start
+    route_ids = np.repeat(np.arange(data['num_vehicles']), np.diff(route_offsets))
+    travel_times = np.bincount(route_ids[:-1], weights=legs, minlength=data['num_vehicles']).astype(np.int64)
+    loads = np.bincount(route_ids, weights=np.asarray(data['demands'])[nodes] * ~is_end,
+                        minlength=data['num_vehicles']).astype(np.int64)
+
+    last_stops = route_offsets[1:] - 2 # last location visited before the end
+    if has_catchment_ends:
+        # Used routes end at a catchment copy, a phlebotomist without orders never leaves home
+        ends = route_offsets[1:] - 1
+        unused_ends = ends[nodes[ends] < num_locations]
+        locations[unused_ends] = locations[unused_ends - 1]
+    elif nearest_catchment_ends:
+        # Travel times from every route's last location to every catchment, in one go
+        last_locations = nodes[last_stops]
+        if 'catchment_times' in data:
+            catchment_time_matrix = np.asarray(data['catchment_times'])[last_locations]
+        else:
+            unique_last_locations, rows = np.unique(last_locations, return_inverse=True)
+            last_coordinates = [data['metadata']['Locations'][location_idx]['Coordinate']
+                                for location_idx in unique_last_locations]
+            catchment_time_matrix = np.asarray(
+                matrix_provider.create_time_matrix(last_coordinates, catchments_coordinates))[rows]
+
+        # Choose catchment with the lowest distance from the last location
+        selected_catchments = catchment_time_matrix.argmin(axis=1)
+        selected_times = catchment_time_matrix[np.arange(len(selected_catchments)), selected_catchments].astype(np.int64)
+        ends = route_offsets[1:] - 1
+        reach_times = cumul_max[last_stops] + selected_times
+        locations[ends] = selected_catchments + len(data['time_matrix'])
+        start_min[ends] = start_max[ends] = cumul_min[ends] = cumul_max[ends] = reach_times
+        travel_times += selected_times
+
+    return {
+        'objective': solution.ObjectiveValue(),
+        'status': routing.status(),
+        'dropped_nodes': dropped_nodes,
+        #Get back the actual Revenue Lost
+        'dropped_revenues': np.asarray(data['revenue_potential'])[dropped_nodes] / data['revenue_scale'],
+        'route_offsets': route_offsets,
+        'locations': locations,
+        'start_times': np.column_stack((start_min, start_max)),
+        'end_times': np.column_stack((cumul_min, cumul_max)),
+        'slack_times': np.column_stack((np.array(slack_min, dtype=np.int64), np.array(slack_max, dtype=np.int64))),
+        'travel_times': travel_times,
+        'loads': loads,
+    }
+
+def printable_route(vehicle_id, locations, start_times, end_times, slack_times):
+    """ Human readable text of one route, from its slices of the extract_solution arrays."""
+    parts = ['Route for Phlebotomist {}:\n'.format(vehicle_id)]
+    for location, start, end, slack in zip(locations[:-1], start_times[:-1], end_times[:-1], slack_times[:-1]):
+        parts.append('Location {0} Start({1},{2}) End({3}, {4}) -> Slack({5}, {6}) -> '.format(
+            location, start[0], start[1], end[0], end[1], slack[0], slack[1]))
+    parts.append('Location {0} Time({1},{2})\n'.format(locations[-1], end_times[-1][0], end_times[-1][1]))
+    return ''.join(parts)
+
+def build_output(data, extraction, printable=True):
+    """
+    The output of run_algorithm as plain Python objects, from the arrays of extract_solution.
 
+    printable: render every route's 'Printable Route' text, which is left out otherwise as it is
+            by far the slowest part for thousands of stops
+    """
+    locations = extraction['locations'].tolist()
+    start_times = extraction['start_times'].tolist()
+    end_times = extraction['end_times'].tolist()
+    slack_times = extraction['slack_times'].tolist()
+    travel_times = extraction['travel_times'].tolist()
+    loads = extraction['loads'].tolist()
+    offsets = extraction['route_offsets'].tolist()
 
-def output_jsonify_verMultiEnds(data, manager, routing, solution, catchments_coordinates, api_key):
-    
-    output = {}
-    metadata = data['metadata']
-    output['Metadata'] = metadata
+    routes = []
+    for vehicle_id in range(len(offsets) - 1):
+        first, end = offsets[vehicle_id], offsets[vehicle_id + 1]
+        phleb_route = {'Phlebotomist Index': vehicle_id}
+        if printable:
+            phleb_route['Printable Route'] = printable_route(vehicle_id, locations[first:end], start_times[first:end],
+                                                             end_times[first:end], slack_times[first:end])
+        phleb_route['Total Travel Time'] = travel_times[vehicle_id]
+        phleb_route['Total Loads'] = loads[vehicle_id]
+        phleb_route['Locations Sequence'] = locations[first:end]
+        phleb_route['Start Times Sequence'] = start_times[first:end]
+        phleb_route['End Times Sequence'] = end_times[first:end]
+        phleb_route['Slack Times Sequence'] = slack_times[first:end - 1]
+        routes.append(phleb_route)
 
     model = {}
-    routes = []
+    model['Objective Number'] = extraction['objective']
+    model['Status'] = extraction['status']
+    model['Total Revenue Lost'] = float(extraction['dropped_revenues'].sum())
+    model["Total Number of Nodes Dropped"] = len(extraction['dropped_nodes'])
+    model["Nodes Dropped"] = extraction['dropped_nodes'].tolist()
+    model["Revenues Dropped"] = extraction['dropped_revenues'].tolist()
+    model['Total Travel Time'] = sum(travel_times)
+    model['Total Loads'] = sum(loads)
+
+    return {'Metadata': data['metadata'], 'Model': model, 'Routes': routes}
+
+def _encode_json(output):
+    return json.dumps(output, indent=2, cls=npEncoder)
 
-    model['Objective Number'] = solution.ObjectiveValue()
-    model['Status'] = routing.status()
+def _encode_compact_json(output):
+    return json.dumps(output, separators=(',', ':'), cls=npEncoder)
 
-    # Dropped Nodes/Customers
-    total_revenue_lost = 0
-    total_node_drops = 0
-    dropped_nodes = []
-    dropped_revenues = []
-    for node in range(routing.Size()):
-        if routing.IsStart(node) or routing.IsEnd(node):
-            continue
-        if solution.Value(routing.NextVar(node)) == node:
-            dropped_nodes.append(manager.IndexToNode(node))
-            dropped_revenues.append(data['revenue_potential'][manager.IndexToNode(node)] / sum(data['time_matrix'][1]))  #Get back the actual Revenue Lost
-            total_revenue_lost += data['revenue_potential'][manager.IndexToNode(node)] / sum(data['time_matrix'][0])
-            total_node_drops += 1
-    
-    model['Total Revenue Lost'] = total_revenue_lost
-    model["Total Number of Nodes Dropped"] = total_node_drops
-    model["Nodes Dropped"] = dropped_nodes
-    model["Revenues Dropped"] = dropped_revenues
-    
+def _encode_orjson(output):
+    import orjson
 
-    # Routes
-    time_dimension = routing.GetDimensionOrDie('Time')
-    total_time = 0
-    total_load = 0
-    for vehicle_id in range(data['num_vehicles']):
-        index = routing.Start(vehicle_id)
-        prev_index = 0
+    return orjson.dumps(output, option=orjson.OPT_SERIALIZE_NUMPY).decode()
 
-        phleb_route = {}
-        route_locations = []
-        route_startTimes =[]
-        route_endTimes = []
-        route_slackTimes = []
-        phleb_route['Phlebotomist Index'] = vehicle_id
+def _encode_msgpack(output):
+    import msgpack
 
-        plan_output = 'Route for Phlebotomist {}:\n'.format(vehicle_id)
+    return msgpack.packb(output, default=lambda obj: obj.item() if isinstance(obj, np.generic) else obj.tolist())
 
-        route_load = 0
-        total_transit_time = 0 
-        while not routing.IsEnd(index):
-            time_var = time_dimension.CumulVar(index)
-            slack_var = time_dimension.SlackVar(index)
+# Serialisers for the output of build_output. 'json' is the original indented format, 'orjson' is the
+# same JSON without the indentation and much faster, 'msgpack' returns bytes
+ENCODERS = {
+    'json': _encode_json,
+    'compact': _encode_compact_json,
+    'orjson': _encode_orjson,
+    'msgpack': _encode_msgpack,
+}
 
-            node_index = manager.IndexToNode(index)
-            route_load += data['demands'][node_index]
-
-            plan_output += 'Location {0} Start({1},{2}) End({3}, {4}) -> Slack({5}, {6}) -> '.format(
-                manager.IndexToNode(index), 
-                solution.Min(time_var) - data['servicing_times'][node_index], solution.Max(time_var) - data['servicing_times'][node_index],
-                solution.Min(time_var) , solution.Max(time_var),
-                solution.Min(slack_var), solution.Max(slack_var))
-            
-            route_locations.append(manager.IndexToNode(index))
-            route_startTimes.append((solution.Min(time_var) - data['servicing_times'][node_index], solution.Max(time_var) - data['servicing_times'][node_index]))
-            route_endTimes.append((solution.Min(time_var) , solution.Max(time_var)))
-            route_slackTimes.append((solution.Min(slack_var), solution.Max(slack_var)))
-            
-            prev_index = index
-            index = solution.Value(routing.NextVar(index))
-      
-            total_transit_time = total_transit_time + data['time_matrix'][manager.IndexToNode(prev_index)][manager.IndexToNode(index)] - data['servicing_times'][manager.IndexToNode(index)]
-
-        # Get the last location's coordinates 
-        last_location_idx = route_locations[-1]
-        last_location_coord = metadata['Locations'][last_location_idx]['Coordinate']
-
-        # Choose catchment with the lowest distance from the last location 
-        response = FE.send_request([last_location_coord], np.array(catchments_coordinates), api_key)
-        catchment_time_matrix = FE.build_time_matrix(response)[0]
-        selected_catchment_idx = np.argmin(catchment_time_matrix)
-        selected_catchment_idx_in_metadata =  selected_catchment_idx + len(data['time_matrix'])
-
-        reach_time = int(route_endTimes[-1][1]) + catchment_time_matrix[selected_catchment_idx]
-
-        plan_output += 'Location {0} Time({1},{2})\n'.format(selected_catchment_idx_in_metadata,
-                                                    reach_time,
-                                                    reach_time)
-        
-        total_transit_time += catchment_time_matrix[selected_catchment_idx]
-        total_time += total_transit_time
-        
-        route_locations.append(selected_catchment_idx_in_metadata)
-        route_startTimes.append((reach_time, reach_time))
-        route_endTimes.append((reach_time, reach_time))
-
-        phleb_route['Printable Route'] = plan_output
-        phleb_route['Total Travel Time'] = total_transit_time
-        phleb_route['Total Loads'] = route_load
-        phleb_route['Locations Sequence'] = route_locations
-        phleb_route['Start Times Sequence'] = route_startTimes
-        phleb_route['End Times Sequence'] = route_endTimes
-        phleb_route['Slack Times Sequence'] = route_slackTimes
+def encode_output(output, encoder='json'):
+    """ Serialise the output of build_output with one of ENCODERS, or with any callable."""
+    if callable(encoder):
+        return encoder(output)
+    if encoder not in ENCODERS:
+        raise ValueError("Unknown encoder '{}', expected one of {}".format(encoder, ', '.join(ENCODERS)))
+    return ENCODERS[encoder](output)
 
-        routes.append(phleb_route)
+def output_jsonify(data, manager, routing, solution, printable=True, encoder='json'):
+    return encode_output(build_output(data, extract_solution(data, manager, routing, solution), printable), encoder)
 
-        total_load += route_load
-    
-    model['Total Travel Time'] = total_time
-    model['Total Loads'] = total_load
-
-    output['Model'] = model
-    output['Routes'] = routes
 
-    return json.dumps(output, indent=2, cls=npEncoder)
+def output_jsonify_verMultiEnds(data, manager, routing, solution, catchments_coordinates, matrix_provider=None,
+                                printable=True, encoder='json'):
+    """
+    Serialise a multi-ends solution whose routes end nowhere, sending every route to the catchment nearest its last stop.
+    See extract_solution for where the travel times to the catchments come from.
+    """
+    extraction = extract_solution(data, manager, routing, solution, catchments_coordinates, matrix_provider)
+    return encode_output(build_output(data, extraction, printable), encoder)
 
 
-def run_algorithm(orders_df, catchments_df, phlebs_df, api_key, isMultiEnds = False):
-    
-    numCatchments = catchments_df.shape[0]
-    numPhleb = phlebs_df.shape[0]
+def prepare_data(orders_df, catchments_df, phlebs_df, matrix_provider, isMultiEnds=False, nativeEnds=True):
+    """
+    Build the FE.ProblemInstance, fetch the time matrix and put them together with create_data_model.
+    Returns (data, catchments_coordinates), the latter is None unless isMultiEnds.
 
-    if (numCatchments > 1) & (isMultiEnds == False):
-        isMultiEnds = True
-        print("Multi-Ending Catchments is detected in the input file, algorithm has switched to Multi-ends version accordingly!")
+    nativeEnds: in the multi-ends version, model the catchments as end nodes (add_catchment_ends) with their
+            travel times taken from the same matrix fetch. False leaves the end arbitrary for
+            output_jsonify_verMultiEnds to pick the nearest catchment afterwards.
+    """
+    instance = FE.build_problem_instance(orders_df, catchments_df, phlebs_df)
+    numCatchments = instance.num_catchments
 
-    coordinates_list = FE.get_coordinates_list(orders_df, catchments_df, phlebs_df)
+    coordinates_list = instance.addresses
 
-    if isMultiEnds:
+    if isMultiEnds and nativeEnds:
+        catchments_coordinates = coordinates_list[0:numCatchments]
+        # One matrix over phlebotomists, orders and catchments, node 0 is the placeholder end
+        locations_coordinates = coordinates_list[numCatchments:] + catchments_coordinates
+        full_time_matrix = matrix_provider.create_time_matrix(locations_coordinates)
+        numLocations = len(locations_coordinates) - numCatchments
+
+        orders_time_matrix = np.zeros((numLocations + 1, numLocations + 1), dtype=np.int32)
+        orders_time_matrix[1:, 1:] = full_time_matrix[:numLocations, :numLocations]
+        catchment_times = np.zeros((numLocations + 1, numCatchments), dtype=np.int32)
+        catchment_times[1:] = full_time_matrix[:numLocations, numLocations:]
+    elif isMultiEnds:
         catchments_coordinates = coordinates_list[0:numCatchments]
         orders_coordinates = coordinates_list[numCatchments:]
 
-        orders_time_matrix = FE.create_time_matrix(orders_coordinates, api_key)
+        orders_time_matrix = matrix_provider.create_time_matrix(orders_coordinates)
     
         # Modify Time Matrix to make the Ending points arbitrary
         col_zeros = np.zeros((len(orders_time_matrix),1))
@@ -317,21 +330,75 @@ def run_algorithm(orders_df, catchments_df, phlebs_df, api_key, isMultiEnds = Fa
         orders_time_matrix = np.array(orders_time_matrix)
         orders_time_matrix = np.hstack((col_zeros, orders_time_matrix))
         orders_time_matrix = np.vstack((row_zeros, orders_time_matrix))
+
+        # Every location's travel times to the catchments, so that output_jsonify_verMultiEnds can pick
+        # each route's nearest catchment in memory (row 0 is the placeholder)
+        catchment_times = np.zeros((len(orders_time_matrix), numCatchments), dtype=np.int32)
+        catchment_times[1:] = matrix_provider.create_time_matrix(orders_coordinates, catchments_coordinates)
     else:
-        time_matrix = FE.create_time_matrix(coordinates_list, api_key) #normal time_matrix with index 0 being the single ending catchment
-
-    order_window = FE.get_timeWindows_list(orders_df, catchments_df, phlebs_df)
-    revenues  = FE.get_orderRevenues_list(orders_df, catchments_df, phlebs_df)
-    servicing_times =  FE.get_servicingTimes_list(orders_df, catchments_df, phlebs_df)
-    expertiseConstraints = FE.get_serviceExpertiseConstraint_list(orders_df, catchments_df, phlebs_df)
-    inverse_ratings = FE.get_inverseRatings_list(orders_df, catchments_df, phlebs_df)
-    metadata = FE.get_metadata(orders_df, catchments_df, phlebs_df)
-    
-    if isMultiEnds:
-        data = create_data_model(orders_time_matrix, order_window, revenues, numPhleb, servicing_times, expertiseConstraints, inverse_ratings, metadata)
-    else:
-        data = create_data_model(time_matrix, order_window, revenues, numPhleb, servicing_times, expertiseConstraints, inverse_ratings, metadata)
+        catchments_coordinates = None
+        time_matrix = matrix_provider.create_time_matrix(coordinates_list) #normal time_matrix with index 0 being the single ending catchment
+
+    data = create_data_model(instance, orders_time_matrix if isMultiEnds else time_matrix)
+
+    if isMultiEnds and nativeEnds:
+        data = add_catchment_ends(data, catchment_times)
+    elif isMultiEnds:
+        data['catchment_times'] = catchment_times
+
+    return data, catchments_coordinates
+
+
+def infeasible_arc_mask(data):
+    """
+    Find the transitions that the time windows rule out before the model is built, so the search never tries them.
+
+    The time cumul of a location is the end of its servicing and lies in its time window shifted by the servicing
+    time (see create_routing_model), and waiting only adds to it. So the arc from i to order j is impossible
+    when even the earliest cumul at i plus the travel and servicing time to j is past the latest cumul at j,
+    e.g. an order at 14:00 can never come before one at 9:00. A vehicle can't serve order j at all when it can't
+    get there in time even over the shortest leg into j from anywhere.
+
+    Returns (arcs, vehicles) as bool arrays, arcs is num_locations x num_locations and True where from -> to
+    can't be used, vehicles is num_locations x num_vehicles and True where the vehicle can't visit the location.
+    Only arcs into orders are ever marked, the catchment ends are always reachable.
+    """
+    num_locations = data['num_locations']
+    num_vehicles = data['num_vehicles']
+    first_order = num_vehicles + 1
+    time_matrix = np.asarray(data['time_matrix'])[:num_locations, :num_locations].astype(np.int64)
+    windows = np.asarray(data['time_windows'], dtype=np.int64)
+    servicing_times = np.asarray(data['servicing_times'][:num_locations], dtype=np.int64)
+
+    earliest = windows[:, 0] + servicing_times
+    latest = windows[:, 1] + servicing_times
+    # Vehicle starts are also held within the break time window of index 0
+    earliest[1:first_order] = np.maximum(earliest[1:first_order], windows[0, 0])
+
+    arcs = np.zeros((num_locations, num_locations), dtype=bool)
+    arcs[1:, first_order:] = earliest[1:, None] + time_matrix[1:, first_order:] > latest[None, first_order:]
+    np.fill_diagonal(arcs, False)
+
+    # Shortest leg into every order from any other location
+    incoming = time_matrix[1:, first_order:].astype(float)
+    incoming[np.arange(num_locations - first_order) + num_vehicles, np.arange(num_locations - first_order)] = np.inf
+    shortest_incoming = incoming.min(axis=0)
+
+    vehicles = np.zeros((num_locations, num_vehicles), dtype=bool)
+    vehicles[first_order:] = earliest[None, 1:first_order] + shortest_incoming[:, None] > latest[first_order:, None]
+    return arcs, vehicles
+
 
+def create_routing_model(data, native_evaluators=True, prune_arcs=True):
+    """
+    Build the OR-Tools routing model for the data from create_data_model.
+    Returns (manager, routing) ready to be solved.
+
+    native_evaluators: register the time matrix and demands natively with the model (fast).
+            False falls back to Python callbacks, kept only for benchmarking against.
+    prune_arcs: remove the transitions ruled out by the time windows (see infeasible_arc_mask) from the
+            NextVar and VehicleVar domains up front. False keeps them, kept only for benchmarking against.
+    """
     # Create the routing index manager.
     manager = pywrapcp.RoutingIndexManager(len(data['time_matrix']),
                                            data['num_vehicles'],
@@ -342,28 +409,37 @@ def run_algorithm(orders_df, catchments_df, phlebs_df, api_key, isMultiEnds = Fa
     # Create Routing Model.
     routing = pywrapcp.RoutingModel(manager)
 
-    # Create and register a transit callback.
-    def time_callback(from_index, to_index):
-        """Returns the travel time between the two nodes."""
-        # Convert from routing variable Index to time matrix NodeIndex.
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        return data['time_matrix'][from_node][to_node]
+    if native_evaluators:
+        # Register the matrix and demands with the model itself, so that OR-Tools evaluates
+        # arcs in C++ instead of calling back into Python millions of times during the search.
+        transit_callback_index = routing.RegisterTransitMatrix(
+            np.asarray(data['time_matrix']).astype(np.int64).tolist())
+    else:
+        # Create and register a transit callback.
+        def time_callback(from_index, to_index):
+            """Returns the travel time between the two nodes."""
+            # Convert from routing variable Index to time matrix NodeIndex.
+            from_node = manager.IndexToNode(from_index)
+            to_node = manager.IndexToNode(to_index)
+            return data['time_matrix'][from_node][to_node]
 
-    transit_callback_index = routing.RegisterTransitCallback(time_callback)
+        transit_callback_index = routing.RegisterTransitCallback(time_callback)
 
     # Define cost of each arc.
     routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
 
-    '''Add demand_callback '''
-    def demand_callback(from_index):
-        """Returns the demand of the node."""
-        # Convert from routing variable Index to demands NodeIndex.
-        from_node = manager.IndexToNode(from_index)
-        return data['demands'][from_node]
-
-    demand_callback_index = routing.RegisterUnaryTransitCallback(
-        demand_callback)
+    if native_evaluators:
+        demand_callback_index = routing.RegisterUnaryTransitVector([int(demand) for demand in data['demands']])
+    else:
+        '''Add demand_callback '''
+        def demand_callback(from_index):
+            """Returns the demand of the node."""
+            # Convert from routing variable Index to demands NodeIndex.
+            from_node = manager.IndexToNode(from_index)
+            return int(data['demands'][from_node])
+
+        demand_callback_index = routing.RegisterUnaryTransitCallback(
+            demand_callback)
     routing.AddDimensionWithVehicleCapacity(
         demand_callback_index,
         0,  # null capacity slack
@@ -386,7 +462,7 @@ def run_algorithm(orders_df, catchments_df, phlebs_df, api_key, isMultiEnds = Fa
         if location_idx == 0:
             continue
         index = manager.NodeToIndex(location_idx)
-        time_dimension.CumulVar(index).SetRange(time_window[0] + data['servicing_times'][index], time_window[1] + data['servicing_times'][index])
+        time_dimension.CumulVar(index).SetRange(int(time_window[0] + data['servicing_times'][location_idx]), int(time_window[1] + data['servicing_times'][location_idx]))
         routing.AddToAssignment(time_dimension.SlackVar(index))
 
     # Add time window constraints for each vehicle start node.
@@ -397,8 +473,9 @@ def run_algorithm(orders_df, catchments_df, phlebs_df, api_key, isMultiEnds = Fa
         routing.AddToAssignment(time_dimension.SlackVar(index))
     
     # Allow to drop nodes.
-    for node in range(numPhleb + 1, len(data['time_matrix'])): #Starting Location should be omitted
-        penalty = data['revenue_potential'][node]
+    num_locations = data.get('num_locations', len(data['time_matrix']))
+    for node in range(data['num_vehicles'] + 1, num_locations): #Starting Location and catchment end copies should be omitted
+        penalty = int(data['revenue_potential'][node])
         routing.AddDisjunction([manager.NodeToIndex(node)], penalty)
 
     for i in range(data["num_vehicles"]):
@@ -410,39 +487,381 @@ def run_algorithm(orders_df, catchments_df, phlebs_df, api_key, isMultiEnds = Fa
         )
 
     #Add Service-Expertise Constraints
-    for location_idx, expConstraints in enumerate(data['expertises']):
-        if location_idx < numPhleb + 1:
-            continue
-
-        index = manager.NodeToIndex(location_idx)
+    first_order = data['num_vehicles'] + 1
+    for order_idx, compatible in enumerate(data['expertise_mask']):
+        index = manager.NodeToIndex(first_order + order_idx)
         vehicles = [-1]
-        vehicles.extend(expConstraints)
+        vehicles.extend(np.flatnonzero(compatible).tolist())
         routing.VehicleVar(index).SetValues(vehicles)
     
+    #Remove the transitions that the time windows make impossible
+    if prune_arcs:
+        arcs, vehicles = infeasible_arc_mask(data)
+        for node in range(1, num_locations):
+            if arcs[node].any():
+                routing.NextVar(manager.NodeToIndex(node)).RemoveValues(
+                    [manager.NodeToIndex(int(to_node)) for to_node in np.flatnonzero(arcs[node])])
+            if vehicles[node].any():
+                routing.VehicleVar(manager.NodeToIndex(node)).RemoveValues(np.flatnonzero(vehicles[node]).tolist())
+
+    #Multi-ends version: every used vehicle ends at exactly one of its own catchment copies (see add_catchment_ends)
+    if data.get('end_copies'):
+        vehicle_ends = [routing.End(vehicle_id) for vehicle_id in range(data['num_vehicles'])]
+        for node in range(data['num_vehicles'] + 1, num_locations):
+            routing.NextVar(manager.NodeToIndex(node)).RemoveValues(vehicle_ends)
+
+        vehicle_copies = [[] for _ in range(data['num_vehicles'])]
+        for offset, (vehicle_id, _) in enumerate(data['end_copies']):
+            index = manager.NodeToIndex(num_locations + offset)
+            routing.VehicleVar(index).SetValues([-1, vehicle_id])
+            routing.NextVar(index).SetValues([index, vehicle_ends[vehicle_id]])
+            routing.AddToAssignment(time_dimension.SlackVar(index))
+            vehicle_copies[vehicle_id].append(index)
+        for copies in vehicle_copies:
+            routing.AddDisjunction(copies, 0, 1)
+
     #Add preference to phlebotomists with better service quality
     for vehicle_id in range(data["num_vehicles"]):
-        routing.SetFixedCostOfVehicle(data['inverse_ratings'][vehicle_id], vehicle_id)
+        routing.SetFixedCostOfVehicle(int(data['inverse_ratings'][vehicle_id]), vehicle_id)
+
+    return manager, routing
+
+
+class SolutionMonitor:
+    """
+    Solution callback that stops the search once the objective has stopped improving.
+
+    OR-Tools calls it on every solution found during the local search. The search is finished
+    early when no improving solution was found for plateau_seconds, or in the last plateau_solutions
+    solutions, whichever comes first (None disables that criterion).
+
+    stop_event: optional threading or multiprocessing Event, once it is set the search is finished at the
+            next solution and the best solution so far is kept (checked at most every STOP_CHECK_SECONDS)
+    """
+    STOP_CHECK_SECONDS = 0.1
+
+    def __init__(self, routing, plateau_seconds=None, plateau_solutions=None, stop_event=None):
+        self.routing = routing
+        self.plateau_seconds = plateau_seconds
+        self.plateau_solutions = plateau_solutions
+        self.stop_event = stop_event
+        self.last_stop_check = None
+        self.start_time = time.monotonic()
+        self.best_objective = None
+        self.last_improvement_time = self.start_time
+        self.solutions_since_improvement = 0
+        self.num_solutions = 0
+
+    def __call__(self):
+        now = time.monotonic()
+        objective = self.routing.CostVar().Max()
+        self.num_solutions += 1
+
+        # Multiprocessing events are checked over a pipe, so not on every one of thousands of solutions
+        if self.stop_event is not None and (self.last_stop_check is None or
+                                            now - self.last_stop_check >= self.STOP_CHECK_SECONDS):
+            self.last_stop_check = now
+            if self.stop_event.is_set():
+                self.routing.solver().FinishCurrentSearch()
+                return
+
+        if self.best_objective is None or objective < self.best_objective:
+            self.best_objective = objective
+            self.last_improvement_time = now
+            self.solutions_since_improvement = 0
+            return
+
+        self.solutions_since_improvement += 1
+        if (self.plateau_seconds is not None and now - self.last_improvement_time >= self.plateau_seconds) or \
+                (self.plateau_solutions is not None and self.solutions_since_improvement >= self.plateau_solutions):
+            self.routing.solver().FinishCurrentSearch()
+
+
+class ProgressReporter:
+    """
+    Solution callback that publishes every improving solution while the search runs, e.g. to stream the
+    incumbent to a client that may accept it early and stop the search.
 
+    publish: called with {'objective', 'dropped', 'elapsed', 'solutions'}: the new objective, the number of
+            orders dropped from it, the seconds since the search started and the solutions found so far
+    order_indices: routing indices of the orders, the only nodes counted as dropped
+    """
+    def __init__(self, routing, order_indices, publish):
+        self.routing = routing
+        self.order_indices = order_indices
+        self.publish = publish
+        self.start_time = time.monotonic()
+        self.best_objective = None
+        self.num_solutions = 0
+
+    def __call__(self):
+        self.num_solutions += 1
+        objective = self.routing.CostVar().Max()
+        if self.best_objective is not None and objective >= self.best_objective:
+            return
+        self.best_objective = objective
+        dropped = sum(1 for index in self.order_indices if self.routing.NextVar(index).Value() == index)
+        self.publish({
+            'objective': objective,
+            'dropped': dropped,
+            'elapsed': round(time.monotonic() - self.start_time, 3),
+            'solutions': self.num_solutions,
+        })
+
+
+def create_search_parameters(time_limit=30, solution_limit=None, log_search=False,
+                             first_solution_strategy='PATH_CHEAPEST_ARC', local_search_metaheuristic='GUIDED_LOCAL_SEARCH'):
+    """
+    Search parameters used by run_algorithm.
+
+    time_limit: wall-clock budget in seconds (may be fractional)
+    solution_limit: stop after this many solutions, None for no limit
+    first_solution_strategy, local_search_metaheuristic: names from OR-Tools' FirstSolutionStrategy
+            and LocalSearchMetaheuristic enums
+    """
     # Setting first solution heuristic.
     search_parameters = pywrapcp.DefaultRoutingSearchParameters()
     search_parameters.first_solution_strategy = (
-        routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC)
+        getattr(routing_enums_pb2.FirstSolutionStrategy, first_solution_strategy))
     search_parameters.local_search_metaheuristic = (
-        routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH)
-    search_parameters.time_limit.seconds = 30
-    search_parameters.log_search = True
+        getattr(routing_enums_pb2.LocalSearchMetaheuristic, local_search_metaheuristic))
+    search_parameters.time_limit.FromMilliseconds(int(time_limit * 1000))
+    if solution_limit is not None:
+        search_parameters.solution_limit = solution_limit
+    search_parameters.log_search = log_search
+    return search_parameters
+
+
+def get_initial_routes(data, manager, previous_output):
+    """
+    Translate a previous output_jsonify result into routes for ReadAssignmentFromRoutes.
+
+    Orders are matched to the current locations by Order Id and phlebotomists by Id, so orders
+    that were cancelled since are stripped and new orders are left unassigned for the solver to insert.
+    Returns one list of routing indices per vehicle.
+    """
+    if isinstance(previous_output, str):
+        previous_output = json.loads(previous_output)
+    previous_metadata = previous_output['Metadata']
+
+    # Only actual orders can be carried over, start/end locations are fixed by the model
+    order_nodes = {location['Order Id']: location['Location Index'] for location in data['metadata']['Locations']
+                   if location['Location Index'] > data['num_vehicles']
+                   and location['Location Index'] < data['num_locations']}
+    vehicles = {str(phleb['Id']): phleb['Phlebotomist Index'] for phleb in data['metadata']['Phlebotomists']}
+    previous_phleb_ids = {phleb['Phlebotomist Index']: str(phleb['Id']) for phleb in previous_metadata['Phlebotomists']}
+    previous_order_ids = [location['Order Id'] for location in previous_metadata['Locations']]
+
+    # Multi-ends version: catchments are matched by coordinate, (vehicle, catchment) -> end copy node
+    end_copies = data.get('end_copies', [])
+    catchment_positions = {location['Coordinate']: location['Location Index'] - data['num_locations']
+                           for location in data['metadata']['Locations']
+                           if location['Location Index'] >= data['num_locations']}
+    copy_nodes = {end_copy: data['num_locations'] + offset for offset, end_copy in enumerate(end_copies)}
+
+    routes = [[] for _ in range(data['num_vehicles'])]
+    for previous_route in previous_output['Routes']:
+        vehicle_id = vehicles.get(previous_phleb_ids.get(previous_route['Phlebotomist Index']))
+        if vehicle_id is None:
+            continue
+        route_nodes = []
+        end_node = None
+        for previous_node in previous_route['Locations Sequence']:
+            if previous_node >= len(previous_order_ids):
+                continue
+            node = order_nodes.get(previous_order_ids[previous_node])
+            if node is not None:
+                route_nodes.append(node)
+            elif end_copies and previous_order_ids[previous_node] == 'Ending Location':
+                coordinate = previous_metadata['Locations'][previous_node]['Coordinate']
+                end_node = copy_nodes.get((vehicle_id, catchment_positions.get(coordinate)))
+
+        if end_copies and route_nodes:
+            if end_node is None:
+                # Previous run ended elsewhere, close the route at the nearest catchment instead
+                vehicle_copy_nodes = [copy_nodes[(vehicle_id, c)] for c in range(len(catchment_positions))]
+                end_node = min(vehicle_copy_nodes, key=lambda copy_node: data['time_matrix'][route_nodes[-1]][copy_node])
+            route_nodes.append(end_node)
+        routes[vehicle_id] = [manager.NodeToIndex(node) for node in route_nodes]
+    return routes
+
+
+def get_solution_routes(routing, solution):
+    """ The visited routing indices of every vehicle, without its start and end (ReadAssignmentFromRoutes format)."""
+    routes = []
+    for vehicle_id in range(routing.vehicles()):
+        route = []
+        index = solution.Value(routing.NextVar(routing.Start(vehicle_id)))
+        while not routing.IsEnd(index):
+            route.append(index)
+            index = solution.Value(routing.NextVar(index))
+        routes.append(route)
+    return routes
 
-    # Solve the problem.
-    solution = routing.SolveWithParameters(search_parameters)
 
-    if solution:
-        if isMultiEnds:
-            return output_jsonify_verMultiEnds(data, manager, routing, solution, catchments_coordinates, api_key)
+def solve(data, time_limit=30, solution_limit=None, plateau_seconds=1, plateau_solutions=200, log_search=False,
+          first_solution_strategy=None, local_search_metaheuristic='GUIDED_LOCAL_SEARCH',
+          initial_routes=None, stop_event=None, progress=None):
+    """
+    Build the routing model for data and solve it, see run_algorithm for the parameters.
+    Returns (manager, routing, solution), solution is None if no solution was found.
+    """
+    if first_solution_strategy is None:
+        # Path extension gets stuck when routes can only be closed through a catchment end copy,
+        # insertion builds all routes with their ends in place from the start.
+        first_solution_strategy = 'PARALLEL_CHEAPEST_INSERTION' if data.get('end_copies') else 'PATH_CHEAPEST_ARC'
+    manager, routing = create_routing_model(data)
+
+    if progress is not None:
+        order_indices = [manager.NodeToIndex(node) for node in range(data['num_vehicles'] + 1, data['num_locations'])]
+        routing.AddAtSolutionCallback(ProgressReporter(routing, order_indices, progress))
+    monitor = SolutionMonitor(routing, plateau_seconds, plateau_solutions, stop_event)
+    routing.AddAtSolutionCallback(monitor)
+    search_parameters = create_search_parameters(time_limit, solution_limit, log_search,
+                                                 first_solution_strategy, local_search_metaheuristic)
+
+    # Solve the problem.
+    solution = None
+    if initial_routes is not None:
+        routing.CloseModelWithParameters(search_parameters)
+        initial_solution = routing.ReadAssignmentFromRoutes(get_initial_routes(data, manager, initial_routes), True)
+        if initial_solution:
+            solution = routing.SolveFromAssignmentWithParameters(initial_solution, search_parameters)
         else:
-            return output_jsonify(data, manager, routing, solution)
+            print("Previous routes are no longer feasible, solving from scratch instead!")
+    if solution is None:
+        solution = routing.SolveWithParameters(search_parameters)
+    return manager, routing, solution
+
+
+# (first solution strategy, metaheuristic) pairs tried in parallel by run_algorithm's portfolio mode
+DEFAULT_PORTFOLIO = [
+    ('PATH_CHEAPEST_ARC', 'GUIDED_LOCAL_SEARCH'),
+    ('SAVINGS', 'GUIDED_LOCAL_SEARCH'),
+    ('PARALLEL_CHEAPEST_INSERTION', 'GUIDED_LOCAL_SEARCH'),
+    ('PATH_CHEAPEST_ARC', 'TABU_SEARCH'),
+    ('PARALLEL_CHEAPEST_INSERTION', 'SIMULATED_ANNEALING'),
+    ('LOCAL_CHEAPEST_INSERTION', 'TABU_SEARCH'),
+    ('SAVINGS', 'SIMULATED_ANNEALING'),
+    ('GLOBAL_CHEAPEST_ARC', 'GUIDED_LOCAL_SEARCH'),
+]
+
+def _solve_portfolio_member(data, first_solution_strategy, local_search_metaheuristic, solve_options):
+    """ Worker process entry point, returns (objective, routes) or (None, None)."""
+    manager, routing, solution = solve(data, first_solution_strategy=first_solution_strategy,
+                                       local_search_metaheuristic=local_search_metaheuristic, **solve_options)
+    if not solution:
+        return None, None
+    return solution.ObjectiveValue(), get_solution_routes(routing, solution)
+
+def solve_portfolio(data, portfolio=DEFAULT_PORTFOLIO, processes=None, **solve_options):
+    """
+    Solve data with the (first solution strategy, metaheuristic) pairs of the portfolio in parallel
+    worker processes, each under the same time limit, and keep the solution with the best objective.
+    Only the first pairs that get a worker of their own are run, so the whole portfolio finishes within
+    the time limit of a single solve.
+    Returns (manager, routing, solution) like solve, with the best routes loaded into a fresh model.
+    """
+    solve_options = dict(solve_options, log_search=False)
+    processes = max(1, min(processes or os.cpu_count() or 1, len(portfolio)))
+    if len(portfolio) > processes:
+        print("Only {} cores for {} portfolio configurations, skipping {}!".format(
+            processes, len(portfolio), ', '.join('{}/{}'.format(*pair) for pair in portfolio[processes:])))
+    portfolio = portfolio[:processes]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(_solve_portfolio_member, data, strategy, metaheuristic, solve_options)
+                   for strategy, metaheuristic in portfolio]
+        results = [future.result() for future in futures]
+
+    results = [result for result in results if result[0] is not None]
+    manager, routing = create_routing_model(data)
+    if not results:
+        return manager, routing, None
+    best_objective, best_routes = min(results, key=lambda result: result[0])
+
+    routing.CloseModelWithParameters(create_search_parameters())
+    solution = routing.ReadAssignmentFromRoutes(best_routes, True)
+    return manager, routing, solution
+
+
+def solve_and_extract(orders_df, catchments_df, phlebs_df, api_key, isMultiEnds = False, cache = None,
+                      matrix_provider = None, time_limit = 30, solution_limit = None, plateau_seconds = 1,
+                      plateau_solutions = 200, log_search = False, initial_routes = None, portfolio = None,
+                      nativeEnds = True, stop_event = None, progress = None):
+    """
+    Match orders to phlebotomists, see run_algorithm for the parameters.
+    Returns (data, status, extraction) where extraction holds the solution's arrays (see extract_solution),
+    or is None when no solution was found, for exports that don't need the JSON output.
+    """
+    if matrix_provider is None:
+        matrix_provider = GoogleMatrixProvider(api_key, cache=cache)
+    
+    numCatchments = catchments_df.shape[0]
+    if (numCatchments > 1) & (isMultiEnds == False):
+        isMultiEnds = True
+        print("Multi-Ending Catchments is detected in the input file, algorithm has switched to Multi-ends version accordingly!")
+
+    data, catchments_coordinates = prepare_data(orders_df, catchments_df, phlebs_df, matrix_provider, isMultiEnds, nativeEnds)
+    solve_options = dict(time_limit=time_limit, solution_limit=solution_limit, plateau_seconds=plateau_seconds,
+                         plateau_solutions=plateau_solutions, log_search=log_search, initial_routes=initial_routes,
+                         stop_event=stop_event, progress=progress)
+    if portfolio:
+        portfolio = DEFAULT_PORTFOLIO if portfolio is True else portfolio
+        manager, routing, solution = solve_portfolio(data, portfolio, **solve_options)
     else:
-         return 'Routing Status: ' + routing.status
-        
+        manager, routing, solution = solve(data, **solve_options)
 
-    
-    
+    if not solution:
+        return data, routing.status(), None
+    if isMultiEnds and not nativeEnds:
+        extraction = extract_solution(data, manager, routing, solution, catchments_coordinates, matrix_provider)
+    else:
+        extraction = extract_solution(data, manager, routing, solution)
+    return data, routing.status(), extraction
+
+def run_algorithm(orders_df, catchments_df, phlebs_df, api_key, isMultiEnds = False, cache = None, matrix_provider = None,
+                  time_limit = 30, solution_limit = None, plateau_seconds = 1, plateau_solutions = 200, log_search = False,
+                  initial_routes = None, portfolio = None, nativeEnds = True, printable = True, encoder = 'json',
+                  stop_event = None, progress = None):
+    """
+    Match orders to phlebotomists and return the routes serialised with encoder (see build_output), a JSON
+    string by default or bytes for 'msgpack'.
+
+    api_key: Google Distance Matrix API key, only used when matrix_provider is not given
+    cache: optional TravelTimeCache for the default Google provider
+    matrix_provider: a MatrixProviders.MatrixProvider supplying the travel times,
+            e.g. RoadNetworkMatrixProvider to solve offline from a road graph
+    time_limit: maximum solve time in seconds, raise it deliberately for large instances
+    solution_limit: stop after this many solutions, None for no limit
+    plateau_seconds, plateau_solutions: stop early once the objective has not improved for this
+            many seconds / solutions (see SolutionMonitor), None to always use the full time limit
+    log_search: print OR-Tools' search log
+    initial_routes: a previous output of run_algorithm (JSON string or dict) to warm-start from, e.g. after
+            orders were added or cancelled mid-day. Its routes are kept as the starting solution so that
+            phlebotomists are not reshuffled, falling back to a fresh solve if they are no longer feasible.
+    portfolio: True to run the DEFAULT_PORTFOLIO of first solution strategies and metaheuristics in parallel
+            worker processes under the same time limit and keep the best, or a list of
+            (first_solution_strategy, local_search_metaheuristic) name pairs to run instead. Pairs beyond the
+            number of cores are skipped so the time limit still holds
+    nativeEnds: with several catchments, let the solver choose each route's end catchment (see add_catchment_ends)
+            instead of picking the nearest one after solving
+    printable: include every route's human readable 'Printable Route' text
+    encoder: how the output is serialised, one of ENCODERS (e.g. 'orjson' for large fleets, 'msgpack' for bytes)
+            or a callable
+    stop_event: an Event to stop the search early and keep the best solution so far (see SolutionMonitor).
+            With portfolio it must be a multiprocessing.Manager().Event() so the worker processes see it
+    progress: a callable receiving every improving solution's objective, dropped orders and elapsed time
+            (see ProgressReporter). With portfolio every worker reports its own search and the callable must be
+            picklable, e.g. the put method of a multiprocessing.Manager().Queue()
+    """
+    data, status, extraction = solve_and_extract(
+        orders_df, catchments_df, phlebs_df, api_key, isMultiEnds=isMultiEnds, cache=cache,
+        matrix_provider=matrix_provider, time_limit=time_limit, solution_limit=solution_limit,
+        plateau_seconds=plateau_seconds, plateau_solutions=plateau_solutions, log_search=log_search,
+        initial_routes=initial_routes, portfolio=portfolio, nativeEnds=nativeEnds, stop_event=stop_event,
+        progress=progress)
+
+    if extraction is not None:
+        return encode_output(build_output(data, extraction, printable), encoder)
+    else:
+         return 'Routing Status: ' + str(status)
@@ -0,0 +1,205 @@
+"""
+Travel time matrix providers.
+
+run_algorithm only needs "the travel time in minutes between these coordinates", so where the
+times come from is pluggable. Every provider takes addresses in the "lat,long" string format
+produced by FE.get_coordinates_list and returns an int32 array of minutes.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import FeatureEngineering as FE
+
+class MatrixProvider:
+    """ Base class for travel time matrix providers."""
+
+    def create_time_matrix(self, origins, destinations=None):
+        """
+        Returns a len(origins) x len(destinations) int32 array of travel times in minutes.
+        If destinations is None, the square matrix between all origins is returned.
+        """
+        raise NotImplementedError
+
+    def cache_key(self):
+        """
+        JSON-able value identifying the travel times this provider returns, used to key cached solves
+        (see ResultCache). None means unknown and solves using the provider are never cached.
+        """
+        return None
+
+
+class GoogleMatrixProvider(MatrixProvider):
+    """
+    Travel times from the Google Distance Matrix API (the original behaviour of run_algorithm).
+
+    api_key: Distance Matrix API key
+    cache: optional TravelTimeCache so that recurring locations are not requested again
+    """
+    def __init__(self, api_key, cache=None, max_workers=FE.MAX_WORKERS, base_url=FE.DISTANCE_MATRIX_URL):
+        self.api_key = api_key
+        self.cache = cache
+        self.max_workers = max_workers
+        self.base_url = base_url
+
+    def create_time_matrix(self, origins, destinations=None):
+        return FE.create_time_matrix(origins, self.api_key, max_workers=self.max_workers, base_url=self.base_url,
+                                     cache=self.cache, destinations=destinations)
+
+    def cache_key(self):
+        return ['google', self.base_url]
+
+
+class HaversineMatrixProvider(MatrixProvider):
+    """
+    Instant approximate travel times from straight-line distance (see FE.estimate_time_matrix),
+    for what-if runs and instances too large to fetch. No network access is needed.
+
+    minutes_per_km, base_minutes: speed/detour factors, calibrate them with from_matrix
+    """
+    def __init__(self, minutes_per_km=FE.DEFAULT_MINUTES_PER_KM, base_minutes=FE.DEFAULT_BASE_MINUTES):
+        self.minutes_per_km = minutes_per_km
+        self.base_minutes = base_minutes
+
+    @classmethod
+    def from_matrix(cls, address_list, time_matrix):
+        """ Fit the factors to a previously fetched matrix between the given addresses."""
+        minutes_per_km, base_minutes = FE.fit_speed_factors(address_list, time_matrix)
+        return cls(minutes_per_km, base_minutes)
+
+    def create_time_matrix(self, origins, destinations=None):
+        return FE.estimate_time_matrix(origins, destinations, self.minutes_per_km, self.base_minutes)
+
+    def cache_key(self):
+        return ['haversine', float(self.minutes_per_km), float(self.base_minutes)]
+
+
+# Travel time used for pairs with no path between them in the road graph,
+# equal to the maximum time per vehicle in run_algorithm so such arcs are never usable.
+UNREACHABLE_MINUTES = 10000
+
+# Road graph held by each worker process, set once by _init_worker instead of being pickled per task
+_worker_graph = None
+
+def _init_worker(graph):
+    global _worker_graph
+    _worker_graph = graph
+
+def _shortest_times(sources, targets):
+    """ Travel times in seconds from each source node to each target node, one Dijkstra per source."""
+    import networkx as nx
+
+    times = np.full((len(sources), len(targets)), np.inf)
+    for row, source in enumerate(sources):
+        lengths = nx.single_source_dijkstra_path_length(_worker_graph, source, weight='travel_time')
+        times[row] = [lengths.get(target, np.inf) for target in targets]
+    return times
+
+
+class RoadNetworkMatrixProvider(MatrixProvider):
+    """
+    Offline travel times computed on an OpenStreetMap drive network (the same graph
+    RouteVisualisation draws routes on), so no network access or API quota is needed.
+
+    All addresses are snapped to their nearest graph nodes in one batch, then the shortest
+    travel time from every distinct origin node is found with Dijkstra over the edges'
+    'travel_time' attribute, split across worker processes.
+
+    graph: an osmnx MultiDiGraph, edge speeds and travel times are added if missing
+    processes: number of worker processes, defaults to the number of cores
+    """
+    def __init__(self, graph, processes=None):
+        from RoadGraphStore import weight_graph
+
+        edge = next(iter(graph.edges(data=True)), (None, None, {}))[2]
+        if 'travel_time' not in edge:
+            graph = weight_graph(graph)
+        self.graph = graph
+        self.processes = processes or os.cpu_count() or 1
+        self._routing_graph = None
+        self._cache_key = None
+
+    @classmethod
+    def from_graphml(cls, filepath, processes=None):
+        """ Load a road graph previously saved with ox.save_graphml."""
+        import osmnx as ox
+
+        return cls(ox.load_graphml(filepath), processes=processes)
+
+    @classmethod
+    def from_polygon(cls, polygon, network_type='drive', filepath=None, processes=None, store=None):
+        """
+        Build the road graph covering the polygon's bounds.
+        If store (a RoadGraphStore) is given, the graph comes from it, shared with RouteVisualisation.
+        Otherwise if filepath is given, the graph is loaded from it when present and saved to it otherwise.
+        """
+        import osmnx as ox
+        from RoadGraphStore import download_graph
+
+        if store is not None:
+            return cls(store.load(polygon, network_type), processes=processes)
+        if filepath is not None and os.path.exists(filepath):
+            return cls.from_graphml(filepath, processes=processes)
+        graph = download_graph(polygon.total_bounds, network_type)
+        provider = cls(graph, processes=processes)
+        if filepath is not None:
+            ox.save_graphml(provider.graph, filepath)
+        return provider
+
+    def cache_key(self):
+        """ Summary of the graph's contents: its size, the bounds of its nodes and its total travel time."""
+        if self._cache_key is None:
+            xs = [x for _, x in self.graph.nodes(data='x')]
+            ys = [y for _, y in self.graph.nodes(data='y')]
+            total_time = sum(travel_time for _, _, travel_time in self.graph.edges(data='travel_time'))
+            self._cache_key = ['road_network', self.graph.number_of_nodes(), self.graph.number_of_edges(),
+                               [round(min(xs), 6), round(min(ys), 6), round(max(xs), 6), round(max(ys), 6)],
+                               round(total_time, 3)]
+        return self._cache_key
+
+    def _get_routing_graph(self):
+        """ Plain DiGraph keeping only the fastest of any parallel edges, which is all Dijkstra needs."""
+        import networkx as nx
+
+        if self._routing_graph is None:
+            routing_graph = nx.DiGraph()
+            for u, v, travel_time in self.graph.edges(data='travel_time'):
+                if not routing_graph.has_edge(u, v) or travel_time < routing_graph[u][v]['travel_time']:
+                    routing_graph.add_edge(u, v, travel_time=travel_time)
+            self._routing_graph = routing_graph
+        return self._routing_graph
+
+    def snap(self, addresses):
+        """ Nearest graph node for every "lat,long" address, in one vectorised query."""
+        import osmnx as ox
+
+        coordinates = FE.parse_coordinates(addresses)
+        return np.asarray(ox.distance.nearest_nodes(self.graph, X=coordinates[:, 1], Y=coordinates[:, 0]))
+
+    def create_time_matrix(self, origins, destinations=None):
+        origin_nodes = self.snap(origins)
+        dest_nodes = origin_nodes if destinations is None else self.snap(destinations)
+
+        # Locations snapping to the same node share one Dijkstra run
+        unique_origins, origin_rows = np.unique(origin_nodes, return_inverse=True)
+        unique_dests, dest_cols = np.unique(dest_nodes, return_inverse=True)
+        sources = unique_origins.tolist()
+        targets = unique_dests.tolist()
+
+        num_chunks = max(1, min(self.processes, len(sources)))
+        chunks = [sources[i::num_chunks] for i in range(num_chunks)]
+        routing_graph = self._get_routing_graph()
+        if num_chunks == 1:
+            _init_worker(routing_graph)
+            chunk_times = [_shortest_times(chunks[0], targets)]
+        else:
+            with ProcessPoolExecutor(max_workers=num_chunks, initializer=_init_worker,
+                                     initargs=(routing_graph,)) as executor:
+                chunk_times = list(executor.map(_shortest_times, chunks, [targets] * num_chunks))
+
+        seconds = np.empty((len(sources), len(targets)))
+        for i, times in enumerate(chunk_times):
+            seconds[i::num_chunks] = times
+
+        minutes = np.where(np.isfinite(seconds), seconds // 60, UNREACHABLE_MINUTES)
+        return minutes[np.ix_(origin_rows, dest_cols)].astype(np.int32)
@@ -0,0 +1,202 @@
+import hashlib
+import json
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import MatchingAlgorithm as MA
+
+# Options that don't change the routes and are left out of the key
+UNKEYED_OPTIONS = {'cache', 'stop_event', 'progress', 'log_search'}
+
+class _NoCacheIdentity(Exception):
+    """ An option value whose effect on the routes can't be told from the value, e.g. a provider without cache_key."""
+
+def _frame_digest(df):
+    """ Digest of a DataFrame's contents, independent of its index and column order."""
+    df = df[sorted(df.columns)]
+    try:
+        row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    except TypeError:
+        # Unhashable cells, e.g. the lists of 'Acceptable Phleb Indices' in the Firebase orders
+        row_hashes = pd.util.hash_pandas_object(df.astype(str), index=False).to_numpy()
+    digest = hashlib.sha256(json.dumps([list(df.columns), [str(dtype) for dtype in df.dtypes]]).encode())
+    digest.update(np.ascontiguousarray(row_hashes).tobytes())
+    return digest.hexdigest()
+
+def _canonical(value):
+    """ JSON-able stand-in for an option value, objects (e.g. matrix providers) by their type and cache_key()."""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_canonical(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _canonical(item) for key, item in value.items()}
+    if callable(value) and hasattr(value, '__qualname__'):
+        return '{}.{}'.format(value.__module__, value.__qualname__)
+    cache_key = getattr(value, 'cache_key', None)
+    identity = cache_key() if callable(cache_key) else None
+    if identity is None:
+        raise _NoCacheIdentity(type(value).__qualname__)
+    return {'type': '{}.{}'.format(type(value).__module__, type(value).__qualname__), 'key': _canonical(identity)}
+
+def instance_key(orders_df, catchments_df, phlebs_df, **params):
+    """
+    Content address of a solve: the three input frames plus the solver parameters.
+    None if a parameter has no cache identity, such solves must not be cached.
+    """
+    try:
+        params = {key: _canonical(value) for key, value in params.items() if key not in UNKEYED_OPTIONS}
+    except _NoCacheIdentity:
+        return None
+    key = hashlib.sha256()
+    for df in (orders_df, catchments_df, phlebs_df):
+        key.update(_frame_digest(df).encode())
+    key.update(json.dumps(params, sort_keys=True).encode())
+    return key.hexdigest()
+
+def is_solution(result):
+    """ Whether a result of run_algorithm or solve_and_extract holds routes and is worth caching."""
+    if isinstance(result, str):
+        return not result.startswith('Routing Status')
+    if isinstance(result, tuple):
+        return result[-1] is not None
+    return result is not None
+
+
+class ResultCache:
+    """
+    Cache of solve results keyed by instance_key, so that resubmitting identical inputs (Streamlit reruns,
+    dispatch tools polling) returns the stored routes instead of solving again.
+
+    Results are kept in memory for the most recent max_memory_entries keys and, if path is given, pickled into
+    a SQLite file shared between processes and restarts.
+
+    path: SQLite file for the disk tier, None to keep results in memory only
+    ttl_seconds: results older than this are treated as missing and purged, None to never expire
+    max_memory_entries, max_disk_entries: least recently used results are evicted beyond these, None for no limit
+    """
+    def __init__(self, path=None, ttl_seconds=None, max_memory_entries=64, max_disk_entries=1000):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._connect()
+
+    def _connect(self):
+        self._conn = None
+        if self.path is None:
+            return
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'key TEXT PRIMARY KEY, value BLOB NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_results_last_used ON results (last_used)')
+        self._conn.commit()
+
+    def _expired(self, created_at, now):
+        return self.ttl_seconds is not None and now - created_at > self.ttl_seconds
+
+    def get(self, key):
+        """ The cached result for key, or None."""
+        now = time.time()
+        with self._lock:
+            if key in self._memory:
+                created_at, value = self._memory[key]
+                if not self._expired(created_at, now):
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._memory[key]
+
+            if self._conn is not None:
+                row = self._conn.execute('SELECT value, created_at FROM results WHERE key = ?', (key,)).fetchone()
+                if row is not None and not self._expired(row[1], now):
+                    self._conn.execute('UPDATE results SET last_used = ? WHERE key = ?', (now, key))
+                    self._conn.commit()
+                    value = pickle.loads(row[0])
+                    self._remember(key, row[1], value)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, value)
+            if self._conn is not None:
+                self._conn.execute('INSERT OR REPLACE INTO results (key, value, created_at, last_used) VALUES (?, ?, ?, ?)',
+                                   (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), now, now))
+                self._evict(now)
+                self._conn.commit()
+
+    def _remember(self, key, created_at, value):
+        self._memory[key] = (created_at, value)
+        self._memory.move_to_end(key)
+        while self.max_memory_entries is not None and len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict(self, now):
+        if self.ttl_seconds is not None:
+            self._conn.execute('DELETE FROM results WHERE created_at < ?', (now - self.ttl_seconds,))
+        if self.max_disk_entries is not None:
+            excess = self._conn.execute('SELECT COUNT(*) FROM results').fetchone()[0] - self.max_disk_entries
+            if excess > 0:
+                self._conn.execute('DELETE FROM results WHERE key IN '
+                                   '(SELECT key FROM results ORDER BY last_used LIMIT ?)', (excess,))
+
+    def get_or_solve(self, orders_df, catchments_df, phlebs_df, api_key, solver=MA.run_algorithm, **options):
+        """
+        The result of solver(orders_df, catchments_df, phlebs_df, api_key, **options), from the cache when the same
+        inputs and options were solved before. solver is run_algorithm or solve_and_extract, only results with
+        routes are cached, and nothing is when an option has no cache identity (see instance_key).
+        """
+        key = instance_key(orders_df, catchments_df, phlebs_df, solver=solver, **options)
+        result = None if key is None else self.get(key)
+        if result is None:
+            result = solver(orders_df, catchments_df, phlebs_df, api_key, **options)
+            if key is not None and is_solution(result):
+                self.put(key, result)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._conn is not None:
+                self._conn.execute('DELETE FROM results')
+                self._conn.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'memory_entries': len(self._memory),
+        }
+
+    def __getstate__(self):
+        # Worker processes get the disk tier only
+        state = self.__dict__.copy()
+        del state['_conn'], state['_lock']
+        state['_memory'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._connect()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
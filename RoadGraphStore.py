@@ -0,0 +1,178 @@
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Formats graphs can be stored in: GraphML is portable and readable by other tools, pickle loads several
+# times faster but only with the networkx/osmnx versions that wrote it
+FORMATS = {'graphml': '.graphml', 'pickle': '.pickle'}
+# Speed of the road types without any 'maxspeed' tag in the graph, typical of urban Gurugram traffic
+FALLBACK_SPEED_KPH = 30
+
+def bounds_key(bounds, precision=4):
+    """ File name friendly key of (west, south, east, north) bounds, rounded to about 10m so equal areas match."""
+    return '_'.join('{:.{}f}'.format(value, precision) for value in bounds)
+
+def download_graph(bounds, network_type='drive'):
+    """ The OpenStreetMap network within (west, south, east, north) bounds."""
+    import osmnx as ox
+
+    west, south, east, north = bounds
+    if int(ox.__version__.split('.')[0]) >= 2:
+        return ox.graph_from_bbox((west, south, east, north), network_type=network_type)
+    return ox.graph_from_bbox(north=north, south=south, east=east, west=west, network_type=network_type)
+
+def weight_graph(graph):
+    """ Add the 'speed_kph' and 'travel_time' (seconds) edge attributes that shortest paths and travel times use."""
+    import osmnx as ox
+
+    graph = ox.add_edge_speeds(graph, fallback=FALLBACK_SPEED_KPH)
+    return ox.add_edge_travel_times(graph)
+
+
+class RoadGraphStore:
+    """
+    On-disk store of road graphs keyed by the bounds of the area and the network type, so rendering routes or
+    computing travel times on the same area works offline once its graph has been downloaded.
+
+    Graphs are stored with edge speeds and travel times already added. Projected graphs (UTM, in metres, for
+    fast nearest node lookups) are stored next to the unprojected ones, their nodes keep their 'lat' and 'lon'.
+    For nearest node lookups alone, node_positions keeps just the projected node coordinates in a small .npz
+    file, which loads in a fraction of the time of a whole graph. The graphs loaded last are also kept in memory.
+
+    directory: folder the graphs are saved in
+    file_format: 'pickle' or 'graphml', see FORMATS. Graphs saved in the other format are still loaded
+    download: whether missing graphs are downloaded, False to only work from the store
+    max_memory_graphs: number of loaded graphs kept in memory
+    """
+    def __init__(self, directory='Road Graphs', file_format='pickle', download=True, max_memory_graphs=2):
+        if file_format not in FORMATS:
+            raise ValueError("file_format must be one of {}".format(sorted(FORMATS)))
+        self.directory = directory
+        self.file_format = file_format
+        self.download = download
+        self.max_memory_graphs = max_memory_graphs
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def path(self, bounds, network_type='drive', projected=False, file_format=None):
+        name = '{}_{}{}'.format(network_type, bounds_key(bounds), '_projected' if projected else '')
+        return os.path.join(self.directory, name + FORMATS[file_format or self.file_format])
+
+    def _read(self, path):
+        import osmnx as ox
+
+        if path.endswith(FORMATS['pickle']):
+            with open(path, 'rb') as file:
+                return pickle.load(file)
+        return ox.load_graphml(path)
+
+    def _write(self, graph, path):
+        import osmnx as ox
+
+        os.makedirs(self.directory, exist_ok=True)
+        # Written to a temporary file first so that an interrupted save never leaves a truncated graph behind
+        temporary_path = path + '.tmp'
+        if path.endswith(FORMATS['pickle']):
+            with open(temporary_path, 'wb') as file:
+                pickle.dump(graph, file, protocol=pickle.HIGHEST_PROTOCOL)
+        else:
+            ox.save_graphml(graph, temporary_path)
+        os.replace(temporary_path, path)
+
+    def _load_stored(self, bounds, network_type, projected):
+        for file_format in [self.file_format] + [f for f in FORMATS if f != self.file_format]:
+            path = self.path(bounds, network_type, projected, file_format)
+            if os.path.exists(path):
+                return self._read(path)
+        return None
+
+    def get(self, bounds, network_type='drive', projected=False):
+        """
+        The weighted graph of the network within (west, south, east, north) bounds, from memory, disk or
+        downloaded (and then saved) in that order.
+        """
+        bounds = tuple(float(value) for value in bounds)
+        key = (bounds_key(bounds), network_type, projected)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+
+            graph = self._load_stored(bounds, network_type, projected)
+            if graph is None:
+                graph = self._build(bounds, network_type, projected)
+                self._write(graph, self.path(bounds, network_type, projected))
+
+            self._memory[key] = graph
+            while len(self._memory) > self.max_memory_graphs:
+                self._memory.popitem(last=False)
+            return graph
+
+    def _build(self, bounds, network_type, projected):
+        if projected:
+            import osmnx as ox
+
+            # Projected from the stored unprojected graph rather than downloaded again
+            graph = self._load_stored(bounds, network_type, False)
+            if graph is None:
+                graph = self._build(bounds, network_type, False)
+                self._write(graph, self.path(bounds, network_type, False))
+            projected_graph = ox.project_graph(graph)
+            # Kept for drawing on maps, osmnx only does so in some versions
+            for node, attributes in graph.nodes(data=True):
+                projected_graph.nodes[node]['lat'] = attributes['y']
+                projected_graph.nodes[node]['lon'] = attributes['x']
+            return projected_graph
+
+        if not self.download:
+            raise FileNotFoundError("No stored {} graph for bounds {} in {}".format(network_type, bounds, self.directory))
+        return weight_graph(download_graph(bounds, network_type))
+
+    def node_positions(self, bounds, network_type='drive'):
+        """
+        (node ids, N x 2 array of x/y in metres, CRS of the x/y) of the graph within the bounds, projected to
+        its UTM zone. Built from the stored graph (see get) the first time.
+        """
+        bounds = tuple(float(value) for value in bounds)
+        key = (bounds_key(bounds), network_type, 'nodes')
+        path = os.path.join(self.directory, '{}_{}_nodes.npz'.format(network_type, bounds_key(bounds)))
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+            if os.path.exists(path):
+                with np.load(path) as stored:
+                    positions = (stored['ids'], stored['xy'], str(stored['crs']))
+            else:
+                positions = None
+
+        if positions is None:
+            positions = self._project_nodes(self.get(bounds, network_type))
+            os.makedirs(self.directory, exist_ok=True)
+            temporary_path = path + '.tmp'
+            with open(temporary_path, 'wb') as file:
+                np.savez(file, ids=positions[0], xy=positions[1], crs=positions[2])
+            os.replace(temporary_path, path)
+
+        with self._lock:
+            self._memory[key] = positions
+            while len(self._memory) > self.max_memory_graphs:
+                self._memory.popitem(last=False)
+        return positions
+
+    def _project_nodes(self, graph):
+        import geopandas as gpd
+
+        ids = np.array(list(graph.nodes))
+        points = gpd.GeoSeries(gpd.points_from_xy([graph.nodes[node]['x'] for node in ids],
+                                                  [graph.nodes[node]['y'] for node in ids]), crs=graph.graph['crs'])
+        crs = points.estimate_utm_crs()
+        points = points.to_crs(crs)
+        return ids, np.column_stack((points.x.to_numpy(), points.y.to_numpy())), crs.to_string()
+
+    def load(self, polygon, network_type='drive', projected=False):
+        """ The graph covering a geopandas polygon's bounds, see get."""
+        return self.get(polygon.total_bounds, network_type, projected)
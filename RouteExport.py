@@ -0,0 +1,94 @@
+"""
+Columnar exports of the matching algorithm's routes.
+
+The tables are built straight from the arrays of MatchingAlgorithm.extract_solution, without going through
+the JSON output, and can be written as Parquet or streamed as Arrow IPC record batches. Both need pyarrow.
+"""
+import io
+
+import numpy as np
+import pandas as pd
+
+MIME_TYPES = {
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+
+def stops_table(data, extraction):
+    """
+    One row per stop of every route: the phlebotomist's start, the orders in visiting order and the catchment
+    the route ends at. Times are minutes of the day, arrival is the start of the servicing and departure its end
+    (the same at the start and end of a route), slack is the waiting time before leaving for the next stop.
+    """
+    instance = data['instance']
+    offsets = extraction['route_offsets']
+    locations = extraction['locations']
+    route_lengths = np.diff(offsets)
+    phleb_index = np.repeat(np.arange(len(route_lengths)), route_lengths)
+
+    first_order = 1 + instance.num_phlebs
+    is_order = (locations >= first_order) & (locations < first_order + instance.num_orders)
+    order_ids = pd.array(np.asarray(instance.order_ids, dtype=object)[np.where(is_order, locations - first_order, 0)])
+    order_ids[~is_order] = None
+    is_end = np.zeros(len(locations), dtype=bool)
+    is_end[offsets[1:] - 1] = True
+    coordinates = instance.location_coordinates()[locations]
+
+    return pd.DataFrame({
+        'phleb_index': phleb_index,
+        'phleb_id': np.asarray(instance.phleb_ids)[phleb_index],
+        'stop': np.arange(len(locations)) - offsets[phleb_index],
+        'stop_type': np.where(is_order, 'order', np.where(is_end, 'end', 'start')),
+        'location_index': locations,
+        'order_id': order_ids,
+        'lat': coordinates[:, 0],
+        'long': coordinates[:, 1],
+        'arrival': extraction['start_times'][:, 0],
+        'departure': extraction['end_times'][:, 0],
+        'slack': extraction['slack_times'][:, 0],
+    })
+
+def routes_table(data, extraction):
+    """ One row per phlebotomist with the number of orders, travel time, load and start/end times of the route."""
+    instance = data['instance']
+    offsets = extraction['route_offsets']
+    return pd.DataFrame({
+        'phleb_index': np.arange(len(offsets) - 1),
+        'phleb_id': instance.phleb_ids,
+        'orders': np.diff(offsets) - 2,
+        'travel_time': extraction['travel_times'],
+        'load': extraction['loads'],
+        'start_time': extraction['end_times'][offsets[:-1], 0],
+        'end_time': extraction['end_times'][offsets[1:] - 1, 0],
+    })
+
+def to_parquet(df):
+    """ The table as the bytes of a Parquet file."""
+    output = io.BytesIO()
+    df.to_parquet(output, engine='pyarrow', index=False)
+    return output.getvalue()
+
+def iter_arrow_stream(df, batch_size=65536):
+    """
+    The table in the Arrow IPC streaming format, yielded piece by piece (schema, then one record batch
+    at a time) so that a web response can start before the whole table is serialised.
+    """
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        for batch in table.to_batches(max_chunksize=batch_size):
+            writer.write_batch(batch)
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    yield sink.getvalue()
+
+def iter_export(df, export_format='arrow', batch_size=65536):
+    """ Serialise the table as 'arrow' (streamed in record batches) or 'parquet' (one file, yielded whole)."""
+    if export_format == 'arrow':
+        return iter_arrow_stream(df, batch_size)
+    if export_format == 'parquet':
+        return iter([to_parquet(df)])
+    raise ValueError("Unknown export format '{}', expected one of {}".format(export_format, ', '.join(MIME_TYPES)))
@@ -9,6 +9,15 @@ import plotly_express as px
 import networkx as nx
 import osmnx as ox
 import folium
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+from scipy.sparse.csgraph import dijkstra
+
+import FeatureEngineering as FE
+from RoadGraphStore import RoadGraphStore
+
+# Road graphs are downloaded once per area and network type, then loaded from disk (see RoadGraphStore)
+road_graphs = RoadGraphStore()
 
 def to_time(time_window):
     """
@@ -29,8 +38,86 @@ def create_popup(text):
                         max_width=300)
     return popup
 
+def snap_addresses(node_positions, addresses_list):
+    """
+    Nearest road graph node of every "lat,long" address, in one KD-tree query.
+
+    node_positions: (node ids, projected x/y, CRS) from RoadGraphStore.node_positions
+    """
+    ids, xy, crs = node_positions
+    coordinates = FE.parse_coordinates(addresses_list)
+    points = gpd.GeoSeries(gpd.points_from_xy(coordinates[:, 1], coordinates[:, 0]), crs='epsg:4326').to_crs(crs)
+    _, nearest = cKDTree(xy).query(np.column_stack((points.x.to_numpy(), points.y.to_numpy())))
+    return ids[nearest]
+
 
-def visualise_routes(json_result, polygon, addresses_list):
+class ShortestPaths:
+    """
+    Shortest paths on a road graph with one single-source Dijkstra per source node, kept for every later path
+    from the same node (e.g. a catchment or a stop shared by several routes).
+
+    graph: osmnx graph, parallel edges count with their lowest weight
+    weight: edge attribute to minimise, 'travel_time' (seconds) or 'length' (metres)
+    """
+    def __init__(self, graph, weight='travel_time'):
+        self.nodes = np.asarray(list(graph.nodes))
+        self.node_index = {node: i for i, node in enumerate(self.nodes.tolist())}
+        edges = [(self.node_index[u], self.node_index[v], w) for u, v, w in graph.edges(data=weight)]
+        u, v, w = (np.array(column) for column in zip(*edges))
+        # Lowest weight of any parallel edges, sparse matrices would add them up
+        order = np.lexsort((w, v, u))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (np.diff(u[order]) != 0) | (np.diff(v[order]) != 0)
+        order = order[first]
+        # Zero weights would be read as missing edges
+        weights = np.maximum(w[order].astype(float), 1e-6)
+        self.matrix = csr_matrix((weights, (u[order], v[order])), shape=(len(self.nodes), len(self.nodes)))
+        self._predecessors = {}
+
+    def prepare(self, sources):
+        """ Run Dijkstra from all the source nodes not seen before, in one batch."""
+        missing = [source for source in dict.fromkeys(sources) if source not in self._predecessors]
+        if missing:
+            indices = [self.node_index[source] for source in missing]
+            _, predecessors = dijkstra(self.matrix, indices=indices, return_predecessors=True)
+            for source, row in zip(missing, predecessors):
+                self._predecessors[source] = row
+
+    def path(self, source, target):
+        """ Nodes of the shortest path from source to target, like nx.shortest_path."""
+        self.prepare([source])
+        predecessors = self._predecessors[source]
+        source_index = self.node_index[source]
+        path = [self.node_index[target]]
+        while path[-1] != source_index:
+            previous = predecessors[path[-1]]
+            if previous < 0:
+                raise nx.NetworkXNoPath(f"No path between {source} and {target}")
+            path.append(previous)
+        return self.nodes[path[::-1]].tolist()
+
+
+def route_coordinates(G, route, weight='travel_time'):
+    """
+    (lat, long) points along a path of nodes, following the curve of each road where the edge has a geometry.
+    Of parallel edges the one lowest in weight is drawn, the one the path was found on.
+    """
+    points = [(G.nodes[route[0]]['y'], G.nodes[route[0]]['x'])]
+    for u, v in zip(route[:-1], route[1:]):
+        edge = min(G[u][v].values(), key=lambda data: data.get(weight, float('inf')))
+        if 'geometry' in edge:
+            points.extend((lat, long) for long, lat in edge['geometry'].coords[1:])
+        else:
+            points.append((G.nodes[v]['y'], G.nodes[v]['x']))
+    return points
+
+def draw_route(route_map, G, route, colour, alpha, weight='travel_time'):
+    """ Draw a path of nodes onto the folium map (ox.plot_route_folium is gone from osmnx 2)."""
+    if len(route) > 1:
+        folium.PolyLine(route_coordinates(G, route, weight), color=colour, weight=6, opacity=alpha).add_to(route_map)
+
+
+def visualise_routes(json_result, polygon, addresses_list, graph_store=None, weight='travel_time'):
     """
     Visualise realistic routes for each phlebotomist and saves them to a .html file
 
@@ -38,10 +125,18 @@ def visualise_routes(json_result, polygon, addresses_list):
         json_result: json output from Run Algorithm.ipynb (matching.json)
         polygon: geojson polygon provided by TATA
         addressess_list: list of addressess compiled - refer to Run Algorithm.ipynb 
+        graph_store: RoadGraphStore to load the road graph from, defaults to road_graphs
+        weight: edge attribute routes are shortest in, 'travel_time' or 'length'
     """
-    # create base graph
-    x_min, y_min, x_max, y_max = polygon.total_bounds
-    G = ox.graph_from_bbox(north=y_max, south=y_min, east=x_max, west=x_min, network_type='drive')
+    # create base graph, downloaded only if the store doesn't have it yet
+    graph_store = graph_store or road_graphs
+    G = graph_store.load(polygon, network_type='drive')
+
+    # snap every address at once, then run Dijkstra once from every location a leg starts at
+    nodes = snap_addresses(graph_store.node_positions(polygon.total_bounds, network_type='drive'), addresses_list)
+    shortest_paths = ShortestPaths(G, weight)
+    shortest_paths.prepare([nodes[location] for phleb in json_result['Routes']
+                            for location in phleb['Locations Sequence'][:-1]])
 
     # colour and opacity of routes and markers
     colours = [
@@ -64,6 +159,7 @@ def visualise_routes(json_result, polygon, addresses_list):
     catchment_popup_text = "Catchment Area"
     catchment_coords = addresses_list[0].split(',')
     catchment_lat, catchment_long = float(catchment_coords[0]), float(catchment_coords[1])
+    route_map = folium.Map(location=(catchment_lat, catchment_long))
 
     for j in range(len(json_result['Routes'])):
         phleb = json_result['Routes'][j]
@@ -77,7 +173,7 @@ def visualise_routes(json_result, polygon, addresses_list):
         start_times = phleb['Start Times Sequence']
         end_times = phleb['End Times Sequence']
 
-        colour = colours[j]
+        colour = colours[j % len(colours)]
         print(colour)
 
         for i in range(len(locations_sequence)-1):
@@ -86,10 +182,10 @@ def visualise_routes(json_result, polygon, addresses_list):
             start_lat, start_long = float(start[0]), float(start[1])
             end_lat, end_long = float(end[0]), float(end[1])
 
-            start_node = ox.distance.nearest_nodes(G, Y=start_lat, X=start_long)
-            end_node = ox.distance.nearest_nodes(G, Y=end_lat, X=end_long)
+            start_node = nodes[locations_sequence[i]]
+            end_node = nodes[locations_sequence[i+1]]
 
-            route = nx.shortest_path(G, start_node, end_node, weight='distance')
+            route = shortest_paths.path(start_node, end_node)
 
             arrival_time = f"Arrival:{to_time(start_times[i])}"
             departure_time = f"Departure:{to_time(end_times[i])}"
@@ -100,10 +196,7 @@ def visualise_routes(json_result, polygon, addresses_list):
             if i == 0:
                 # phlebotomist home
                 print(f"Map created for Phlebotomist ID #{phleb_id}'s route")
-                if j == 0:
-                    route_map = ox.plot_route_folium(G, route, route_linewidth=6, node_size=0, color=colour, opacity=alpha)
-                else: 
-                    route_map = ox.plot_route_folium(G, route, route_linewidth=6, node_size=0, route_map=route_map, color=colour, opacity=alpha)
+                draw_route(route_map, G, route, colour, alpha, weight)
                 # create markers
                 start_marker = folium.Marker(
                     location=(start_lat, start_long), # only accepts coords in tuple form
@@ -112,8 +205,8 @@ def visualise_routes(json_result, polygon, addresses_list):
                 )
                 start_marker.add_to(route_map)
             else:
-                # if map has been created, add onto route map
-                route_map = ox.plot_route_folium(G, route, route_linewidth=6, node_size=0, route_map=route_map, color=colour, opacity=alpha)
+                # add onto route map
+                draw_route(route_map, G, route, colour, alpha, weight)
                 start_marker = folium.Marker(
                     location=(start_lat, start_long), # only accepts coords in tuple form
                     popup=create_popup(f'Order #{order_id}<br>{arrival_time}<br>{departure_time}'),
@@ -133,6 +226,8 @@ def visualise_routes(json_result, polygon, addresses_list):
                     icon = folium.Icon(color='red', icon='vial', prefix='fa')
                 )
     catchment_marker.add_to(route_map)
+    coordinates = FE.parse_coordinates(addresses_list)
+    route_map.fit_bounds([coordinates.min(axis=0).tolist(), coordinates.max(axis=0).tolist()])
     route_map.save(f"Route Visualisations/Route.html")
    
 # for testing purposes
@@ -0,0 +1,217 @@
+"""
+Background solve jobs for the web API and the Streamlit frontend.
+
+A solve holds the GIL for its whole time limit, so jobs run in a pool of worker processes and the web
+server's threads stay free to accept new requests and report on running jobs. Jobs are cancelled through
+a shared event that the solver's SolutionMonitor checks, so a cancelled job still returns its best
+solution so far, and every improving solution is sent back over a shared queue (see iter_progress).
+"""
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import MatchingAlgorithm as MA
+from ResultCache import instance_key, is_solution
+
+QUEUED = 'queued'
+RUNNING = 'running'
+CANCELLING = 'cancelling'
+DONE = 'done'
+CANCELLED = 'cancelled'
+FAILED = 'failed'
+
+def _run_job(solver, orders_df, catchments_df, phlebs_df, api_key, options, started_event, stop_event, progress_queue):
+    """ Worker process entry point."""
+    started_event.set()
+    return solver(orders_df, catchments_df, phlebs_df, api_key, stop_event=stop_event,
+                  progress=progress_queue.put, **options)
+
+
+class SolveJob:
+    """ One submitted solve, see JobManager.get for its status."""
+    def __init__(self, job_id, future, started_event, stop_event, progress_queue=None, cached=False, key=None):
+        self.id = job_id
+        self.key = key
+        self.future = future
+        self.started_event = started_event
+        self.stop_event = stop_event
+        self.progress_queue = progress_queue
+        self.progress_events = []
+        self.cached = cached
+        self.submitted_at = time.time()
+        self.finished_at = None
+
+    def status(self):
+        if self.future.cancelled():
+            return CANCELLED
+        if self.future.done():
+            if self.future.exception() is not None:
+                return FAILED
+            return CANCELLED if self.stop_event.is_set() else DONE
+        if self.started_event.is_set():
+            return CANCELLING if self.stop_event.is_set() else RUNNING
+        return QUEUED
+
+
+class JobManager:
+    """
+    Runs solver jobs in a pool of worker processes. Submitting the inputs and options of a job that is still
+    queued or running returns that job instead of starting another.
+
+    max_workers: number of solves running at once, defaults to the number of cores. Further jobs are queued
+    max_finished_jobs: finished jobs kept for their results, the oldest are forgotten beyond this
+    result_cache: optional ResultCache, jobs with inputs and options solved before complete straight away
+            and the results of completed (not cancelled) jobs are added to it
+    solver: MA.run_algorithm for the JSON output, or MA.solve_and_extract for (data, status, extraction)
+    """
+    def __init__(self, max_workers=None, max_finished_jobs=100, result_cache=None, solver=MA.run_algorithm):
+        self.solver = solver
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_finished_jobs = max_finished_jobs
+        self.result_cache = result_cache
+        self._executor = None
+        self._sync_manager = None
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _start(self):
+        # Started on the first job, so that importing the API doesn't spawn processes
+        if self._executor is None:
+            self._sync_manager = multiprocessing.Manager()
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+
+    def submit(self, orders_df, catchments_df, phlebs_df, api_key, **options):
+        """ Queue a solver call with the given options and return its job id."""
+        key = instance_key(orders_df, catchments_df, phlebs_df, solver=self.solver, **options)
+        if self.result_cache is not None and key is not None:
+            result = self.result_cache.get(key)
+            if result is not None:
+                return self._add_cached(result)
+
+        with self._lock:
+            for job in self._jobs.values():
+                if key is not None and job.key == key and job.status() in (QUEUED, RUNNING):
+                    return job.id
+            self._start()
+            started_event = self._sync_manager.Event()
+            stop_event = self._sync_manager.Event()
+            progress_queue = self._sync_manager.Queue()
+            future = self._executor.submit(_run_job, self.solver, orders_df, catchments_df, phlebs_df, api_key, options,
+                                           started_event, stop_event, progress_queue)
+            job = SolveJob(uuid.uuid4().hex, future, started_event, stop_event, progress_queue, key=key)
+            self._jobs[job.id] = job
+            future.add_done_callback(lambda _: self._finished(job))
+            self._forget_finished()
+        return job.id
+
+    def _finished(self, job):
+        job.finished_at = time.time()
+        if self.result_cache is not None and job.key is not None and job.status() == DONE and is_solution(job.future.result()):
+            self.result_cache.put(job.key, job.future.result())
+
+    def _add_cached(self, result):
+        future = Future()
+        future.set_result(result)
+        started_event = threading.Event()
+        started_event.set()
+        job = SolveJob(uuid.uuid4().hex, future, started_event, threading.Event(), cached=True)
+        job.finished_at = job.submitted_at
+        with self._lock:
+            self._jobs[job.id] = job
+            self._forget_finished()
+        return job.id
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.future.done()]
+        for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        """
+        Status of the job as a dict, None for an unknown job id. 'result' holds the output of the solver
+        once the job is done, or the best solution found before it was cancelled while running.
+        """
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        status = job.status()
+        info = {
+            'id': job.id,
+            'status': status,
+            'submitted_at': job.submitted_at,
+            'finished_at': job.finished_at,
+            'cached': job.cached,
+        }
+        if job.future.done() and not job.future.cancelled():
+            if status == FAILED:
+                info['error'] = repr(job.future.exception())
+            else:
+                info['result'] = job.future.result()
+        return info
+
+    def cancel(self, job_id):
+        """
+        Cancel the job. A queued job never runs, a running one stops at its next solution and a finished
+        one is left as it is. Returns False for an unknown job id.
+        """
+        job = self._jobs.get(job_id)
+        if job is None:
+            return False
+        if not job.future.cancel() and not job.future.done():
+            job.stop_event.set()
+        return True
+
+    def _drain_progress(self, job):
+        """ Move the job's queued progress events into job.progress_events, which every reader shares."""
+        with self._lock:
+            while job.progress_queue is not None:
+                try:
+                    job.progress_events.append(job.progress_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+    def progress(self, job_id):
+        """ The job's improving solutions so far without waiting for more (see iter_progress), None for an unknown job id."""
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        self._drain_progress(job)
+        return list(job.progress_events)
+
+    def iter_progress(self, job_id, poll_seconds=0.25):
+        """
+        Yield ('incumbent', event) for every improving solution of the job (see MA.ProgressReporter), from the
+        first one on even if the job started earlier, then ('status', {'id', 'status'}) once the job is finished.
+        """
+        job = self._jobs.get(job_id)
+        if job is None:
+            return
+        sent = 0
+        while True:
+            finished = job.future.done()
+            self._drain_progress(job)
+            for event in job.progress_events[sent:]:
+                yield 'incumbent', event
+            sent = len(job.progress_events)
+            if finished:
+                yield 'status', {'id': job.id, 'status': job.status()}
+                return
+            time.sleep(poll_seconds)
+
+    def shutdown(self, cancel_running=True):
+        with self._lock:
+            if self._executor is None:
+                return
+            if cancel_running:
+                for job in self._jobs.values():
+                    if not job.future.cancel():
+                        job.stop_event.set()
+            self._executor.shutdown(wait=True)
+            self._sync_manager.shutdown()
+            self._executor = None
+            self._sync_manager = None
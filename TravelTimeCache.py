@@ -0,0 +1,123 @@
+import sqlite3
+import threading
+import time
+
+class TravelTimeCache:
+    """
+    On-disk cache of travel times (in minutes) keyed by (origin "lat,long", destination "lat,long").
+
+    Phlebotomists' homes and catchments barely move between runs, so most of the matrix for a
+    recurring daily workload can be served from here and only the new pairs are sent to the API.
+
+    path: SQLite file to store the cache in, ":memory:" keeps it for the lifetime of the object only
+    ttl_seconds: entries older than this are treated as missing and purged, None to never expire
+    max_entries: when exceeded, the least recently used entries are evicted, None for no limit
+    """
+    def __init__(self, path='travel_time_cache.sqlite', ttl_seconds=7 * 24 * 3600, max_entries=1000000):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connect()
+
+    def _connect(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS travel_times ('
+            'origin TEXT NOT NULL, destination TEXT NOT NULL, minutes INTEGER NOT NULL, '
+            'fetched_at REAL NOT NULL, last_used REAL NOT NULL, '
+            'PRIMARY KEY (origin, destination))')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_last_used ON travel_times (last_used)')
+        self._conn.commit()
+
+    def get_many(self, origins, destinations):
+        """
+        Look up every origin x destination pair.
+        Returns a dict {(origin, destination): minutes} holding only the pairs that were found.
+        """
+        origins = list(dict.fromkeys(origins))
+        destinations = list(dict.fromkeys(destinations))
+        now = time.time()
+        found = {}
+        with self._lock:
+            # One query per origin, served by the (origin, destination) primary key index
+            dest_set = set(destinations)
+            for origin in origins:
+                rows = self._conn.execute(
+                    'SELECT destination, minutes, fetched_at FROM travel_times WHERE origin = ?', (origin,))
+                for destination, minutes, fetched_at in rows:
+                    if destination in dest_set and not self._expired(fetched_at, now):
+                        found[(origin, destination)] = minutes
+            self._conn.executemany(
+                'UPDATE travel_times SET last_used = ? WHERE origin = ? AND destination = ?',
+                [(now, o, d) for o, d in found])
+            self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(origins) * len(destinations) - len(found)
+        return found
+
+    def put_many(self, times):
+        """ Store {(origin, destination): minutes} and evict anything expired or over the size limit."""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO travel_times (origin, destination, minutes, fetched_at, last_used) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(o, d, int(minutes), now, now) for (o, d), minutes in times.items()])
+            self._evict(now)
+            self._conn.commit()
+
+    def _expired(self, fetched_at, now):
+        return self.ttl_seconds is not None and now - fetched_at > self.ttl_seconds
+
+    def _evict(self, now):
+        if self.ttl_seconds is not None:
+            self._conn.execute('DELETE FROM travel_times WHERE fetched_at < ?', (now - self.ttl_seconds,))
+        if self.max_entries is not None:
+            excess = self._count() - self.max_entries
+            if excess > 0:
+                self._conn.execute(
+                    'DELETE FROM travel_times WHERE rowid IN '
+                    '(SELECT rowid FROM travel_times ORDER BY last_used LIMIT ?)', (excess,))
+
+    def _count(self):
+        # Callers hold self._lock
+        return self._conn.execute('SELECT COUNT(*) FROM travel_times').fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            return self._count()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM travel_times')
+            self._conn.commit()
+
+    def stats(self):
+        """ Hit/miss counters since this cache object was opened. Every hit is one billed API element saved."""
+        with self._lock:
+            hits, misses, entries = self.hits, self.misses, self._count()
+        lookups = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / lookups if lookups else 0.0,
+            'entries': entries,
+        }
+
+    def __getstate__(self):
+        # SQLite connections can't be pickled, worker processes reopen the same file instead
+        # (a ":memory:" cache starts out empty in each worker)
+        state = self.__dict__.copy()
+        del state['_conn'], state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._connect()
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,133 @@
+"""
+create_time_matrix and send_request against a local stub of the Distance Matrix API.
+
+Addresses are "i,0" strings and the stub answers i * 10 + j minutes from address "i,0" to "j,0",
+so every cell of an assembled matrix can be checked.
+"""
+import json
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+import FeatureEngineering as FE
+from TravelTimeCache import TravelTimeCache
+
+
+class StubDistanceMatrix(BaseHTTPRequestHandler):
+    # Keep-alive, like the real API
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        origins = query['origins'][0].split('|')
+        destinations = query['destinations'][0].split('|')
+        with self.server.lock:
+            self.server.requests.append((origins, destinations))
+            self.server.clients.add(self.client_address)
+            failure = self.server.failures.pop(0) if self.server.failures else None
+
+        if failure == 503:
+            self._send(503, {})
+        elif failure is not None:
+            self._send(200, {'status': failure, 'rows': []})
+        else:
+            rows = [{'elements': [{'status': 'OK', 'duration': {'value': minutes(origin, dest) * 60}}
+                                  for dest in destinations]} for origin in origins]
+            self._send(200, {'status': 'OK', 'rows': rows})
+
+    def _send(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def minutes(origin, dest):
+    return int(origin.split(',')[0]) * 10 + int(dest.split(',')[0])
+
+def addresses(indices):
+    return ['{},0'.format(i) for i in indices]
+
+def expected_matrix(origins, destinations):
+    return np.array([[minutes(origin, dest) for dest in destinations] for origin in origins], dtype=np.int32)
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubDistanceMatrix)
+    server.requests = []
+    server.clients = set()
+    server.failures = []
+    server.lock = threading.Lock()
+    server.url = 'http://127.0.0.1:{}/distancematrix/json'.format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_blocks_are_assembled_into_the_matrix(server):
+    address_list = addresses(range(30))
+    matrix = FE.create_time_matrix(address_list, 'key', base_url=server.url)
+
+    assert matrix.dtype == np.int32
+    assert np.array_equal(matrix, expected_matrix(address_list, address_list))
+    for origins, destinations in server.requests:
+        assert len(origins) <= FE.MAX_DIMENSION and len(destinations) <= FE.MAX_DIMENSION
+        assert len(origins) * len(destinations) <= FE.MAX_ELEMENTS
+    requested = {(o, d) for origins, destinations in server.requests for o in origins for d in destinations}
+    assert len(requested) == 30 * 30
+
+def test_rectangular_matrix(server):
+    origins, destinations = addresses(range(7)), addresses(range(20, 33))
+    matrix = FE.create_time_matrix(origins, 'key', base_url=server.url, destinations=destinations)
+    assert np.array_equal(matrix, expected_matrix(origins, destinations))
+
+def test_connections_are_reused_across_calls(server):
+    address_list = addresses(range(30))
+    for _ in range(3):
+        FE.create_time_matrix(address_list, 'key', base_url=server.url, max_workers=2)
+
+    # One connection per request thread, however many calls and requests
+    assert len(server.requests) > 2
+    assert len(server.clients) <= 2
+
+def test_transient_failures_are_retried(server):
+    server.failures = [503, 'OVER_QUERY_LIMIT']
+    response = FE.send_request(addresses([1, 2]), addresses([3]), 'key', base_url=server.url, backoff=0.01)
+
+    assert len(server.requests) == 3
+    assert np.array_equal(FE.build_time_matrix(response), [[13], [23]])
+
+def test_retries_give_up_after_max_retries(server):
+    server.failures = ['OVER_QUERY_LIMIT'] * 3
+    with pytest.raises(FE.TransientRequestError):
+        FE.send_request(addresses([1]), addresses([2]), 'key', base_url=server.url, max_retries=2, backoff=0.01)
+    assert len(server.requests) == 3
+
+def test_cache_only_requests_missing_pairs(server):
+    cache = TravelTimeCache(':memory:')
+    known = addresses(range(12))
+    FE.create_time_matrix(known, 'key', base_url=server.url, cache=cache)
+    server.requests.clear()
+
+    address_list = known + addresses([40, 41])
+    matrix = FE.create_time_matrix(address_list, 'key', base_url=server.url, cache=cache)
+
+    assert np.array_equal(matrix, expected_matrix(address_list, address_list))
+    requested = [(o, d) for origins, destinations in server.requests for o in origins for d in destinations]
+    missing = {(o, d) for o in address_list for d in address_list if o not in known or d not in known}
+    assert sorted(requested) == sorted(missing)
+
+    server.requests.clear()
+    FE.create_time_matrix(address_list, 'key', base_url=server.url, cache=cache)
+    assert server.requests == []
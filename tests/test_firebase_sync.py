@@ -0,0 +1,87 @@
+"""
+sync_frames against an in-memory stand-in for the Realtime Database's multi-path update.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import APIFirebase
+
+
+class StubDatabase:
+    """ Applies multi-path updates like Firebase: "tree/key" paths are set, None removes them."""
+    def __init__(self):
+        self.tree = {}
+        self.requests = []
+
+    def update(self, data):
+        self.requests.append(data)
+        for path, value in data.items():
+            tree, key = path.split('/')
+            if value is None:
+                self.tree.get(tree, {}).pop(key, None)
+            else:
+                self.tree.setdefault(tree, {})[key] = value
+
+
+@pytest.fixture
+def frames():
+    orders = pd.DataFrame({'order_id': [10, 11, 12], 'price': [100.0, np.nan, 300.0], 'lat': [28.4, 28.5, 28.6]})
+    phlebs = pd.DataFrame({'phleb_id': [1, 2], 'capacity': [8, 10]})
+    catchments = pd.DataFrame({'lat': [28.45], 'long': [77.08]})
+    return orders, phlebs, catchments
+
+@pytest.fixture
+def state_path(tmp_path):
+    return str(tmp_path / 'sync_state.json')
+
+
+def test_full_sync_writes_every_row(frames, state_path):
+    orders, phlebs, catchments = frames
+    db = StubDatabase()
+    written = APIFirebase.sync_frames(db, orders, phlebs, catchments, state_path=state_path)
+
+    assert written == 6
+    assert len(db.requests) == 1
+    assert sorted(db.tree['orders']) == ['10', '11', '12']
+    assert sorted(db.tree['phlebotomists']) == ['1', '2']
+    assert sorted(db.tree['catchment']) == ['0']
+    assert db.tree['orders']['12']['price'] == 300.0
+    assert db.tree['orders']['10']['updated_at'] == APIFirebase.SERVER_TIMESTAMP
+
+def test_nan_is_written_as_none(frames, state_path):
+    db = StubDatabase()
+    APIFirebase.sync_frames(db, *frames, state_path=state_path)
+    assert db.tree['orders']['11']['price'] is None
+
+def test_unchanged_incremental_sync_writes_nothing(frames, state_path):
+    db = StubDatabase()
+    APIFirebase.sync_frames(db, *frames, state_path=state_path)
+    db.requests.clear()
+
+    assert APIFirebase.sync_frames(db, *frames, incremental=True, state_path=state_path) == 0
+    assert db.requests == []
+
+def test_incremental_sync_writes_changed_added_and_deleted_rows(frames, state_path):
+    orders, phlebs, catchments = frames
+    db = StubDatabase()
+    APIFirebase.sync_frames(db, orders, phlebs, catchments, state_path=state_path)
+    db.requests.clear()
+
+    orders = orders[orders['order_id'] != 10].copy()
+    orders.loc[orders['order_id'] == 12, 'price'] = 350.0
+    orders = pd.concat([orders, pd.DataFrame({'order_id': [13], 'price': [50.0], 'lat': [28.7]})])
+    written = APIFirebase.sync_frames(db, orders, phlebs, catchments, incremental=True, state_path=state_path)
+
+    assert written == 3
+    assert set(db.requests[0]) == {'orders/10', 'orders/12', 'orders/13'}
+    assert db.requests[0]['orders/10'] is None
+    assert sorted(db.tree['orders']) == ['11', '12', '13']
+    assert db.tree['orders']['12']['price'] == 350.0
+
+def test_updates_are_sent_in_chunks(frames, state_path):
+    orders, phlebs, catchments = frames
+    db = StubDatabase()
+    APIFirebase.sync_frames(db, orders, phlebs, catchments, state_path=state_path, chunk_size=4)
+    assert [len(request) for request in db.requests] == [4, 2]
+    assert sum(len(tree) for tree in db.tree.values()) == 6